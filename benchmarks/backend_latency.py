@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# Measure publish-to-delivery latency through a backend: one process
+# publishes a signal every millisecond, and another, subscribed to it,
+# records how long each took to arrive. With "throughput" the signals
+# are published as fast as possible instead, and the rate they arrive
+# at is reported too.
+#
+#   python benchmarks/backend_latency.py ipc:///tmp/clientsignal-bench.sock
+#   python benchmarks/backend_latency.py redis://localhost:6379/0
+#   python benchmarks/backend_latency.py redis+streams://localhost:6379/0
+#   python benchmarks/backend_latency.py redis://localhost:6379/0 throughput
+#
+# Run it with each backend to compare them. The Redis backends need a
+# Redis server (5.0 or later for streams). Django is configured with the
+# given backend, so no project is needed.
+
+import sys
+import os
+import os.path
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure(CLIENTSIGNAL_BACKEND=(sys.argv[1:2] or
+        ['ipc:///tmp/clientsignal-bench.sock'])[0])
+
+import tornado.ioloop
+from django.dispatch import Signal
+
+from clientsignal import SignalConnection
+
+THROUGHPUT = sys.argv[2:3] == ['throughput']
+
+# Signals published in each IOLoop tick, a millisecond apart.
+MESSAGES = 50000 if THROUGHPUT else 2000
+PER_TICK = 1000 if THROUGHPUT else 2
+
+ping = Signal()
+
+class BenchConnection(SignalConnection):
+    __channel__ = 'clientsignal_bench'
+
+BenchConnection.broadcast('ping', ping)
+
+
+def subscribe(count):
+    """ Subscribe to the ping channel and record the latency of each
+    message until count have arrived. """
+    io_loop = tornado.ioloop.IOLoop.instance()
+    subscriber = BenchConnection.get_subscriber()
+    latencies = []
+    received = []
+
+    def on_channel_message(channel, body):
+        kwargs = BenchConnection._codec.decode(
+                body.split(':', 2)[2])['data']
+        now = time.time()
+        latencies.append(now - kwargs['sent'])
+        received.append(now)
+        if len(latencies) == count:
+            io_loop.stop()
+
+    subscriber.on_channel_message = on_channel_message
+    subscriber.register(BenchConnection, 
+            BenchConnection.get_signal_channel('ping'))
+
+    io_loop.add_timeout(io_loop.time() + 30, io_loop.stop)
+    io_loop.start()
+
+    elapsed = received[-1] - received[0] if len(received) > 1 else 0
+    return latencies, elapsed
+
+
+def publish(count):
+    io_loop = tornado.ioloop.IOLoop.instance()
+    sent = [0]
+
+    def tick():
+        for i in range(PER_TICK):
+            ping.send(sender=None, sent=time.time())
+        sent[0] += PER_TICK
+        if sent[0] < count:
+            io_loop.add_timeout(io_loop.time() + 0.001, tick)
+        else:
+            # Leave time for whatever is still buffered to be sent.
+            io_loop.add_timeout(io_loop.time() + (5 if THROUGHPUT else 0.5),
+                    io_loop.stop)
+
+    # Give the subscriber time to subscribe.
+    io_loop.add_timeout(io_loop.time() + 1, tick)
+    io_loop.start()
+
+
+def main():
+    pid = os.fork()
+    if pid == 0:
+        publish(MESSAGES)
+        os._exit(0)
+
+    latencies, elapsed = subscribe(MESSAGES)
+    latencies.sort()
+    os.waitpid(pid, 0)
+
+    if not latencies:
+        print 'No messages received.'
+        return
+
+    def percentile(p):
+        return latencies[int(len(latencies) * p / 100.0)] * 1e3
+
+    print '%s: %d of %d messages' % (settings.CLIENTSIGNAL_BACKEND, 
+            len(latencies), MESSAGES)
+    print '  %8s %8s %8s %8s' % ('p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+    print '  %8.3f %8.3f %8.3f %8.3f' % (percentile(50), percentile(90),
+            percentile(99), latencies[-1] * 1e3)
+    if THROUGHPUT and elapsed:
+        print '  %d messages/s' % (len(latencies) / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# Compare the JSON event envelope with the MessagePack wire format:
+# bytes on the wire, and encode and decode time per event.
+#
+#   python benchmarks/wire_format.py [iterations]
+#
+# Requires msgpack. Django is configured with its default settings, so
+# no project is needed.
+
+import sys
+import os.path
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from clientsignal.codec import get_codec
+
+EVENT_NAMES = ['tick', 'quote', 'position', 'notification', 'chat']
+
+def numeric_stream():
+    return ('tick', {
+        'series': random.randint(0, 100),
+        'time': 1384902000 + random.randint(0, 86400),
+        'values': [random.random() * 100 for i in range(16)],
+    })
+
+def small_ints():
+    return ('position', {
+        'x': random.randint(0, 1920),
+        'y': random.randint(0, 1080),
+        'user': random.randint(0, 10000),
+    })
+
+def text_payload():
+    return ('notification', {
+        'title': u'Order %d shipped' % random.randint(0, 100000),
+        'body': u'Your order has been shipped and should arrive soon. ' * 4,
+        'unread': random.randint(0, 50),
+        'urgent': False,
+    })
+
+PAYLOADS = [
+    ('numeric stream', numeric_stream),
+    ('small integers', small_ints),
+    ('text', text_payload),
+]
+
+
+def measure(codec, events, iterations):
+    encoded = [codec.encode_event(n, k) for n, k in events]
+    size = sum(len(e) for e in encoded) / float(len(encoded))
+
+    encode = timeit.timeit(
+            lambda: [codec.encode_event(n, k) for n, k in events],
+            number=iterations)
+    decode = timeit.timeit(
+            lambda: [codec.decode(e) for e in encoded],
+            number=iterations)
+
+    count = float(len(events) * iterations)
+    return size, encode / count * 1e6, decode / count * 1e6
+
+
+def main(iterations=200):
+    codecs = [
+        ('json', get_codec('json')),
+        ('fastjson', get_codec('fastjson')),
+        ('msgpack+base64', get_codec('msgpack').with_events(EVENT_NAMES)),
+    ]
+
+    for title, payload in PAYLOADS:
+        events = [payload() for i in range(100)]
+        print '%s:' % title
+        print '  %-16s %10s %12s %12s' % ('codec', 'bytes', 'encode us',
+                'decode us')
+        for name, codec in codecs:
+            size, encode, decode = measure(codec, events, iterations)
+            print '  %-16s %10.1f %12.2f %12.2f' % (name, size, encode,
+                    decode)
+        print
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
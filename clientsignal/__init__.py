@@ -32,10 +32,21 @@ from clientsignal.conn import BaseSignalConnection
 from clientsignal.conn import SimpleSignalConnection
 
 from clientsignal.redisconn import RedisSignalConnection
+from clientsignal.ipcconn import IPCSignalConnection
+from clientsignal.streamconn import RedisStreamSignalConnection
  
 import clientsignal.settings as app_settings
+from clientsignal.utils import get_backend_url_parts
  
-SignalConnection = SimpleSignalConnection
+# The signal connection for the configured backend.
+BACKENDS = {
+    'redis': RedisSignalConnection,
+    'ipc': IPCSignalConnection,
+    'redis+streams': RedisStreamSignalConnection,
+}
+SignalConnection = BACKENDS.get(
+        get_backend_url_parts(app_settings.CLIENTSIGNAL_BACKEND)['scheme'],
+        SimpleSignalConnection)
 
 __all__ = [
             'signal_object_hook',
@@ -43,6 +54,8 @@ __all__ = [
             'BaseSignalConnection',
             'SimpleSignalConnection',
             'RedisSignalConnection',
+            'IPCSignalConnection',
+            'RedisStreamSignalConnection',
             'SignalConnection',
             'app_settings',
           ]
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Will Barton.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright 
+#      notice, this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright 
+#      notice, this list of conditions and the following disclaimer in the 
+#      documentation and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL
+# THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Shared parts of the signal connections that send signals between
+# processes through a message broker (Redis, or the local IPC broker).
+# A backend provides a publisher, with publish(channel, message) and
+# publish_many(messages), and a Subscriber that subscribes to channels
+# and hands the messages it receives to on_channel_message().
+#
+# Messages are "origin:name:encoded event", where origin is the id of
+# the process that published it if that process has already delivered
+# it to its own connections, and name is BATCH_NAME for a list of
+# events.
+
+import os
+import uuid
+from collections import defaultdict, OrderedDict
+
+import clientsignal.settings as app_settings
+from clientsignal.conn import BaseSignalConnection
+from clientsignal.batch import add_to_batch
+from clientsignal.utils import ioloop_running
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# An id for this process, sent with messages it has already delivered to
+# its own connections. It's regenerated in forked children.
+ORIGIN = None
+def get_origin():
+    global ORIGIN
+    pid = os.getpid()
+    if ORIGIN is None or ORIGIN[0] != pid:
+        ORIGIN = (pid, uuid.uuid4().hex)
+    return ORIGIN[1]
+
+
+# The name of messages that carry a batch of events, encoded as a list,
+# rather than a single event.
+BATCH_NAME = '*'
+
+
+def check_name(name):
+    """ Raise ValueError if the signal or event name can't be put in a
+    message: it can't contain ':'. """
+    if ':' in name:
+        raise ValueError("Signal and event names can't contain ':': %s" % 
+                name)
+
+
+class Backoff(object):
+    """ Exponentially increasing delays between attempts to reach the
+    backend, from delay up to max_delay seconds. """
+
+    delay = app_settings.CLIENTSIGNAL_BACKEND_OPTIONS.get(
+            'RECONNECT_DELAY', 0.1)
+    max_delay = app_settings.CLIENTSIGNAL_BACKEND_OPTIONS.get(
+            'MAX_RECONNECT_DELAY', 5)
+
+    def __init__(self):
+        self.current = None
+
+    @property
+    def failing(self):
+        return self.current is not None
+
+    def next(self):
+        """ Return the delay before the next attempt. """
+        if self.current is None:
+            self.current = self.delay
+        else:
+            self.current = min(self.current * 2, self.max_delay)
+        return self.current
+
+    def reset(self):
+        self.current = None
+
+
+class Subscriber(object):
+    """
+    A single subscription to the backend shared by all of the signal
+    connections in this process. Each channel is subscribed to once,
+    when the first connection class (or topic, or user) using it has a
+    client connect, and every message received is handed to the open
+    connections routed to that channel. Opening and closing client
+    connections doesn't touch the backend at all, except when a topic or
+    user gains its first or loses its last connection.
+
+    Subclasses implement subscribe() and unsubscribe().
+    """
+
+    def __init__(self):
+        # Channel name -> (connection class, index, key) routes with
+        # clients in this process. Messages go to the connections in
+        # getattr(conn_cls, index)[key] (e.g. conn_cls._topics[topic]),
+        # or to every open connection of the class if index is None.
+        self.channels = defaultdict(set)
+
+    def register(self, conn_cls, channel, index=None, key=None):
+        """ Route messages on the given channel to the connection class,
+        or only to its connections in the given index under key,
+        subscribing to the channel if necessary. """
+        routes = self.channels[channel]
+        route = (conn_cls, index, key)
+        if route in routes:
+            return
+
+        subscribe = not routes
+        routes.add(route)
+
+        if subscribe:
+            self.subscribe(channel)
+
+    def unregister(self, conn_cls, channel, index=None, key=None):
+        """ Stop routing messages on the channel to the connection class
+        (or index key), unsubscribing from the channel once nothing in
+        this process needs it. """
+        routes = self.channels.get(channel)
+        if routes is None:
+            return
+
+        routes.discard((conn_cls, index, key))
+        if not routes:
+            del self.channels[channel]
+            self.unsubscribe(channel)
+
+    def subscribe(self, channel):
+        raise NotImplementedError()
+
+    def unsubscribe(self, channel):
+        raise NotImplementedError()
+
+    def resubscribe(self):
+        """ Subscribe to every channel we know about, after 
+        reconnecting. """
+        for channel in self.channels.keys():
+            self.subscribe(channel)
+
+    def on_channel_message(self, channel, body):
+        origin, name, encoded = body.split(':', 2)
+        if origin == get_origin():
+            # Sent from this process, and already delivered.
+            return
+
+        if name == BATCH_NAME:
+            self.on_batch(channel, encoded)
+            return
+
+        log.debug("Sending signal from %s: %s %s" % 
+                (channel, name, encoded))
+        # The event is already encoded, so it only needs framing, once,
+        # for all of the clients of each class.
+        self.deliver(channel, name, encoded=encoded)
+
+    def on_batch(self, channel, encoded):
+        """ Deliver each of the events in a batch message. """
+        routes = self.channels.get(channel)
+        if not routes:
+            return
+
+        conn_cls = iter(routes).next()[0]
+        for evt in conn_cls._codec.decode(encoded):
+            self.deliver(channel, evt['event'], evt['data'])
+
+    def deliver(self, channel, name, kwargs=None, encoded=None):
+        """ Deliver the event, published on the given channel, to this
+        process's connections. """
+        for conn_cls, index, key in list(self.channels.get(channel, ())):
+            # Messages sent to a user can be any event, and aren't
+            # replayed; everything else is a broadcast signal.
+            if index == '_users':
+                conn_cls.deliver(conn_cls._users.get(key, ()), name, 
+                        kwargs, encoded, replay=False)
+            elif name not in conn_cls._broadcast_signals:
+                continue
+            elif index is None:
+                conn_cls.deliver(conn_cls._connections, name, kwargs, 
+                        encoded)
+            else:
+                conn_cls.deliver(getattr(conn_cls, index).get(key, ()), 
+                        name, kwargs, encoded, topic=key)
+
+    def on_lost(self):
+        """ Called when the connection to the backend is lost, and with
+        it any messages published until it's back. """
+        for conn_cls in set(route[0] for routes in self.channels.values()
+                for route in routes):
+            if conn_cls.replay_size:
+                conn_cls.get_replay_buffer().mark_lost()
+
+
+class BackendSignalConnection(BaseSignalConnection):
+    """
+    A signal connection whose broadcast signals are published through a
+    backend, to the connections in every process subscribed to them.
+    Subclasses provide the backend's get_publisher() and
+    get_subscriber().
+    """
+
+    # This is the channel of this connection.
+    __channel__ = app_settings.CLIENTSIGNAL_BACKEND_OPTIONS.get('CHANNEL_PREFIX', 'clientsignal') + "_default"
+
+    # The channel of each broadcast signal, formatted with this class's
+    # __channel__ and the signal's name. A format without %(name)s
+    # publishes every signal on one channel.
+    channel_format = app_settings.CLIENTSIGNAL_BACKEND_OPTIONS.get(
+            'CHANNEL_FORMAT', '%(channel)s.%(name)s')
+
+    @classmethod
+    def get_publisher(cls):
+        """ The publisher to use in the current thread. """
+        raise NotImplementedError()
+
+    @classmethod
+    def get_subscriber(cls):
+        """ This process's subscriber. """
+        raise NotImplementedError()
+
+    @classmethod
+    def get_signal_channel(cls, name):
+        """ The channel the broadcast signal with the given name is
+        published to. """
+        return cls.channel_format % {'channel': cls.__channel__, 
+                'name': name}
+
+    @classmethod
+    def get_signal_channels(cls):
+        return set(cls.get_signal_channel(name) 
+                for name in cls._broadcast_signals)
+
+    @classmethod
+    def get_topic_channel(cls, topic):
+        """ The channel signals sent with the given topic are published
+        to. """
+        # Clients name topics, so topic and user channels are set apart
+        # from the signal channels with ':', which a signal's name can't
+        # contain (see check_name()), and from each other by their
+        # prefix. No topic can name another channel.
+        return "%s:topic:%s" % (cls.__channel__, topic)
+
+    @classmethod
+    def topic_added(cls, topic):
+        cls.get_subscriber().register(cls, 
+                channel=cls.get_topic_channel(topic), 
+                index='_topics', key=topic)
+
+    @classmethod
+    def topic_removed(cls, topic):
+        cls.get_subscriber().unregister(cls, 
+                channel=cls.get_topic_channel(topic), 
+                index='_topics', key=topic)
+
+        # The topic's broadcasts won't be received, or kept for replay,
+        # until it's subscribed to again.
+        if cls.replay_size:
+            cls.get_replay_buffer().mark_gap(topic)
+
+    @classmethod
+    def get_user_channel(cls, user_id):
+        """ The channel events sent to the given user are published to.
+        Only processes with connections of that user subscribe to it. 
+        """
+        return "%s:user:%s" % (cls.__channel__, user_id)
+
+    @classmethod
+    def user_added(cls, user_id):
+        cls.get_subscriber().register(cls, 
+                channel=cls.get_user_channel(user_id), 
+                index='_users', key=user_id)
+
+    @classmethod
+    def user_removed(cls, user_id):
+        cls.get_subscriber().unregister(cls, 
+                channel=cls.get_user_channel(user_id), 
+                index='_users', key=user_id)
+
+    @classmethod
+    def send_to_user(cls, user_id, name, **kwargs):
+        check_name(name)
+        channel = cls.get_user_channel(user_id)
+        origin = cls.deliver_local(channel, [(name, kwargs)])
+        cls.get_publisher().publish(channel, 
+                cls.encode_message(name, kwargs, origin))
+
+    @classmethod
+    def get_event_channel(cls, name, kwargs):
+        """ The channel to publish the broadcast signal with the given
+        name and kwargs to. """
+        # Signals sent with a topic go to the topic's own channel, which
+        # only processes with subscribers to it are listening to.
+        topic = kwargs.get('topic')
+        if topic is None:
+            return cls.get_signal_channel(name)
+        return cls.get_topic_channel(topic)
+
+    @classmethod
+    def encode_message(cls, name, kwargs, origin=''):
+        """ Encode an event as a backend message, 
+        "origin:name:encoded event". """
+        return "%s:%s:%s" % (origin, name, 
+                cls._codec.encode_event(name, kwargs))
+
+    @classmethod
+    def deliver_local(cls, channel, events):
+        """
+        Deliver (name, kwargs) events for the given channel straight to
+        this process's connections, without waiting for them to come
+        back from the backend, if this is the IOLoop's thread. Returns
+        the origin id to publish them with, so that this process ignores
+        them when they do, or '' if they weren't delivered.
+        """
+        if not ioloop_running():
+            return ''
+
+        subscriber = cls.get_subscriber()
+        for name, kwargs in events:
+            subscriber.deliver(channel, name, kwargs)
+        return get_origin()
+
+    @classmethod
+    def publish(cls, name, kwargs):
+        """ Publish the broadcast signal with the given name and kwargs 
+        to the backend. """
+        channel = cls.get_event_channel(name, kwargs)
+        log.debug("BROADCAST: Sending %s signal to channel %s" % 
+                (name, channel))
+        origin = cls.deliver_local(channel, [(name, kwargs)])
+        cls.get_publisher().publish(channel, 
+                cls.encode_message(name, kwargs, origin))
+
+    @classmethod
+    def publish_many(cls, events):
+        """ Publish a batch of (name, kwargs) broadcast signals to the
+        backend at once, as one message for each channel. """
+        channels = OrderedDict()
+        for name, kwargs in events:
+            channel = cls.get_event_channel(name, kwargs)
+            channels.setdefault(channel, []).append((name, kwargs))
+
+        messages = []
+        for channel, channel_events in channels.items():
+            origin = cls.deliver_local(channel, channel_events)
+            if len(channel_events) == 1:
+                name, kwargs = channel_events[0]
+                message = cls.encode_message(name, kwargs, origin)
+            else:
+                message = "%s:%s:%s" % (origin, BATCH_NAME, cls._codec.encode(
+                    [{'event': name, 'data': kwargs} 
+                        for name, kwargs in channel_events]))
+            messages.append((channel, message))
+
+        cls.get_publisher().publish_many(messages)
+
+    # This is called from the Django side.
+    @classmethod
+    def register_signal(cls, name, signal, listen=False, broadcast=False):
+        check_name(name)
+        super(BackendSignalConnection, cls).register_signal(name, 
+                signal, listen=listen, broadcast=broadcast)
+
+        if listen:
+            ## Listen signals
+            # Create an event handler to wrap the signal from a client
+            # and add it to the EventConnection's _events.
+            if name not in cls._events:
+                def handler(conn, *args, **kwargs):
+                    log.info(str(conn) + " received signal " + name)
+                    signal.send(conn.request.user, **kwargs)
+
+                log.debug("Registering signal to listen from client %s" % name)
+                cls._events[name] = handler
+
+        if broadcast:
+            # Generate a listener function for the given signal with the
+            # given name and return it. This function will be connected to
+            # the signal and will publish it to the backend on receipt.
+            def listener_factory(name, signal):
+                def listener(sender, **kwargs):
+                    # Remove the 'signal' object from the kwargs, it's not
+                    # serializable, and we don't need it.
+                    del kwargs['signal']
+                    kwargs['sender'] = sender
+
+                    # Inside batched_broadcasts() the signal is held
+                    # and published with the rest of the batch.
+                    if not add_to_batch(cls, name, kwargs):
+                        cls.publish(name, kwargs)
+
+                return listener
+
+            # Receive the signal within Django and publish it to the
+            # channel for this connection.
+            log.debug("Registering signal for broadcast to client %s" % name)
+
+            listener = listener_factory(name, signal)
+
+            # We don't want a weakref to the handler function, we don't
+            # want it garbage collected.
+            signal.connect(listener, weak=False)
+
+            # Signals added while connections are open need their
+            # channel subscribed to now.
+            if cls._connections:
+                cls.get_subscriber().register(cls, 
+                        cls.get_signal_channel(name))
+
+    def on_open(self, connection_info):
+        cls = self.__class__
+        subscribe = not cls._connections
+        super(BackendSignalConnection, self).on_open(connection_info)
+
+        # The first connection of this class in this process subscribes
+        # to its signals' channels. The subscriber delivers messages to
+        # everything in self._connections. If it was closed already, on
+        # opening, there's nothing to deliver to.
+        if subscribe and not self.is_closed:
+            subscriber = cls.get_subscriber()
+            for channel in cls.get_signal_channels():
+                subscriber.register(cls, channel)
+
+    def on_close(self):
+        super(BackendSignalConnection, self).on_close()
+
+        # The last one unsubscribes from them.
+        cls = self.__class__
+        if not cls._connections:
+            subscriber = cls.get_subscriber()
+            for channel in cls.get_signal_channels():
+                subscriber.unregister(cls, channel)
+
+            if cls.replay_size:
+                cls.get_replay_buffer().mark_gap(None)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Will Barton.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright 
+#      notice, this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright 
+#      notice, this list of conditions and the following disclaimer in the 
+#      documentation and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL
+# THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Broadcast signals sent inside batched_broadcasts(), or during a
+# request with BatchedBroadcastMiddleware, are held in a batch for the
+# current thread and sent together when it ends, rather than one at a
+# time, and not at all if it ends with an exception. Signals whose
+# broadcast has a coalesce_key only send their latest value for each
+# key.
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import count
+
+from django.db import transaction
+
+import logging
+log = logging.getLogger(__name__)
+
+
+_local = threading.local()
+
+
+class BroadcastBatch(object):
+
+    def __init__(self):
+        # Key -> (connection class, name, kwargs), in the order sent.
+        self.events = OrderedDict()
+        self._counter = count()
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, conn_cls, name, kwargs):
+        limit = conn_cls.get_queue_limit(name)
+        if limit is not None and limit.coalesce_key is not None:
+            # A newer signal with the same key replaces the older one,
+            # in its place.
+            key = (conn_cls,) + conn_cls.get_coalesce_key(name, limit, 
+                    kwargs)
+        else:
+            key = next(self._counter)
+
+        self.events[key] = (conn_cls, name, kwargs)
+
+    def extend(self, batch):
+        for conn_cls, name, kwargs in batch.events.values():
+            self.add(conn_cls, name, kwargs)
+
+    def send(self):
+        """ Send the batch, one publish_many() for each connection 
+        class. """
+        classes = OrderedDict()
+        for conn_cls, name, kwargs in self.events.values():
+            classes.setdefault(conn_cls, []).append((name, kwargs))
+        self.events.clear()
+
+        for conn_cls, events in classes.items():
+            log.debug("Sending a batch of %s signals for %s" % 
+                    (len(events), conn_cls.__name__))
+            try:
+                conn_cls.publish_many(events)
+            except Exception, e:
+                log.error("Cannot send batched signals for %s: %s" % 
+                        (conn_cls.__name__, e))
+
+
+def get_batch():
+    """ Return the innermost batch for this thread, or None. """
+    batches = getattr(_local, 'batches', None)
+    if batches:
+        return batches[-1]
+    return None
+
+
+def add_to_batch(conn_cls, name, kwargs):
+    """ Add the signal to this thread's batch. Returns False if there
+    isn't one, and it should be sent now. """
+    batch = get_batch()
+    if batch is None:
+        return False
+
+    batch.add(conn_cls, name, kwargs)
+    return True
+
+
+def start_batch():
+    """ Start a batch for this thread, nested in any it has already,
+    and return it. """
+    if getattr(_local, 'batches', None) is None:
+        _local.batches = []
+    batch = BroadcastBatch()
+    _local.batches.append(batch)
+    return batch
+
+
+def end_batch(send=True, batch=None):
+    """
+    End this thread's innermost batch, or the given batch along with
+    any started inside it that weren't ended, which are discarded. A
+    nested batch is added to the one outside of it. The outermost is
+    sent once the current transaction commits, if the database supports
+    on_commit(), and otherwise right away. send=False discards the
+    batch.
+    """
+    batches = _local.batches
+    if batch is None:
+        batch = batches.pop()
+    elif batch in batches:
+        del batches[batches.index(batch):]
+    else:
+        # Already ended.
+        return
+
+    if not send or not batch:
+        return
+
+    outer = get_batch()
+    if outer is not None:
+        outer.extend(batch)
+        return
+
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is not None:
+        on_commit(batch.send)
+    else:
+        batch.send()
+
+
+@contextmanager
+def batched_broadcasts():
+    """
+    Hold broadcast signals sent inside the block and send them together
+    at the end, or drop them if the block raises.
+
+        with batched_broadcasts():
+            for item in items:
+                item.save()     # sends item_saved
+
+    On Django versions without transaction.on_commit() the batch is sent
+    when the block ends, so put it outside of any transaction block.
+    """
+    start_batch()
+    try:
+        yield
+    except:
+        end_batch(send=False)
+        raise
+    end_batch()
+
+
+class BatchedBroadcastMiddleware(object):
+    """
+    Hold the broadcast signals sent while handling each request, and
+    send them together once the response is ready. They're dropped if
+    the view raises or the response is a server error. 
+    
+    On Django versions without transaction.on_commit(), list this before
+    TransactionMiddleware so that the batch is sent after the commit.
+    """
+
+    def process_request(self, request):
+        # Another middleware can return a response, or raise, before
+        # ours runs for the last request, leaving its batch open. The
+        # next request's would be nested in it and never sent.
+        leaked = getattr(_local, 'request_batch', None)
+        if leaked is not None and leaked in getattr(_local, 'batches', ()):
+            log.warning("Discarding %s broadcast signals from a request "
+                    "whose batch wasn't ended" % len(leaked))
+            end_batch(send=False, batch=leaked)
+
+        request._clientsignal_batch = _local.request_batch = start_batch()
+
+    def process_exception(self, request, exception):
+        self.end_request_batch(request, send=False)
+
+    def process_response(self, request, response):
+        self.end_request_batch(request, 
+                send=response.status_code < 500)
+        return response
+
+    def end_request_batch(self, request, send):
+        batch = getattr(request, '_clientsignal_batch', None)
+        if batch is None:
+            return
+
+        del request._clientsignal_batch
+        if getattr(_local, 'request_batch', None) is batch:
+            _local.request_batch = None
+        end_batch(send=send, batch=batch)
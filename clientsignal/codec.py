@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Will Barton. 
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright 
+#      notice, this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright 
+#      notice, this list of conditions and the following disclaimer in the 
+#      documentation and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL
+# THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import base64
+import json as stdlib_json
+import simplejson as json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from django.core.exceptions import ImproperlyConfigured
+
+import clientsignal.settings as app_settings
+from clientsignal.utils import get_class_or_func
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Codecs turn events into messages for the wire and back. Each
+# EventConnection class has one, set with its codec attribute to either
+# the name of a registered codec or the import path of a Codec class or
+# instance, and resolved once when the class is created.
+class Codec(object):
+    # Whether encoded messages are binary rather than text.
+    binary = False
+
+    def encode(self, data):
+        raise NotImplementedError()
+
+    def decode(self, message):
+        raise NotImplementedError()
+
+    def encode_event(self, name, kwargs, seq=None):
+        """ Encode an "event", a message that encapsulates a name and 
+        some keyword arguments, and its sequence number if it has one. 
+        """
+        if seq is None:
+            return self.encode({'event':name, 'data':kwargs})
+        return self.encode({'event':name, 'data':kwargs, 'seq':seq})
+
+    def add_sequence(self, message, seq):
+        """ Add a sequence number to an already-encoded event. """
+        evt = self.decode(message)
+        return self.encode_event(evt['event'], evt['data'], seq)
+
+    def with_events(self, names):
+        """ Return a codec for a connection class whose events have the
+        given names. Codecs that intern event names return a copy with
+        their own name table. """
+        return self
+
+
+class JSONCodec(Codec):
+    """ 
+    JSON encoding with simplejson, using the configured encoder class
+    and object hook (CLIENTSIGNAL_JSON_ENCODER and
+    CLIENTSIGNAL_JSON_OBJECT_HOOK by default). These can be classes and
+    functions or their import paths, and are imported on first use.
+    """
+
+    def __init__(self, encoder=None, object_hook=None):
+        self.encoder_cls = encoder or app_settings.CLIENTSIGNAL_JSON_ENCODER
+        self.object_hook = object_hook or app_settings.CLIENTSIGNAL_JSON_OBJECT_HOOK
+        self._encoder = None
+        self._decoder = None
+
+    def get_encoder(self):
+        if self._encoder is None:
+            encoder_cls = self.encoder_cls
+            if isinstance(encoder_cls, basestring):
+                encoder_cls = get_class_or_func(encoder_cls)
+            self._encoder = encoder_cls(separators=(',', ':'))
+        return self._encoder
+
+    def get_decoder(self):
+        if self._decoder is None:
+            object_hook = self.object_hook
+            if isinstance(object_hook, basestring):
+                object_hook = get_class_or_func(object_hook)
+            self._decoder = json.JSONDecoder(object_hook=object_hook)
+        return self._decoder
+
+    def encode(self, data):
+        return self.get_encoder().encode(data)
+
+    def decode(self, message):
+        return self.get_decoder().decode(message)
+
+    def add_sequence(self, message, seq):
+        # Encoded events are JSON objects, so the number can be added
+        # without decoding them.
+        return '{"seq":%d,%s' % (seq, message[1:])
+
+
+class FastJSONCodec(JSONCodec):
+    """
+    JSON encoding with the standard library's C-accelerated encoder and
+    decoder. The configured encoder class is only used for objects the
+    standard library can't encode natively.
+    """
+
+    def get_encoder(self):
+        if self._encoder is None:
+            fallback = super(FastJSONCodec, self).get_encoder()
+            self._encoder = stdlib_json.JSONEncoder(separators=(',', ':'),
+                    default=fallback.default)
+        return self._encoder
+
+    def get_decoder(self):
+        if self._decoder is None:
+            object_hook = self.object_hook
+            if isinstance(object_hook, basestring):
+                object_hook = get_class_or_func(object_hook)
+            self._decoder = stdlib_json.JSONDecoder(object_hook=object_hook)
+        return self._decoder
+
+
+class MessagePackCodec(Codec):
+    """
+    MessagePack encoding, base64 encoded so that it can travel over any
+    SockJS transport. Events are encoded as [name, kwargs] arrays (or
+    [name, kwargs, seq]), with the name replaced by a small integer if
+    it is in the codec's event table (see with_events()), and decoded
+    back into the same {'event':..., 'data':...} dictionaries that the
+    JSON codecs produce.
+    An array of events decodes to a list of dictionaries.
+
+    Objects MessagePack can't encode natively are handled by the
+    configured JSON encoder class's default().
+    """
+    binary = True
+
+    def __init__(self, encoder=None, object_hook=None, event_ids=None):
+        if msgpack is None:
+            raise ImproperlyConfigured('MessagePackCodec requires msgpack')
+
+        self.fallback = JSONCodec(encoder, object_hook)
+        self.event_ids = event_ids or {}
+        self.event_names = dict((i, n) for n, i in self.event_ids.items())
+        self._packer = None
+
+    def with_events(self, names):
+        event_ids = dict((n, i) for i, n in enumerate(sorted(names)))
+        return MessagePackCodec(self.fallback.encoder_cls,
+                self.fallback.object_hook, event_ids)
+
+    def get_packer(self):
+        if self._packer is None:
+            self._packer = msgpack.Packer(use_bin_type=False,
+                    default=self.fallback.get_encoder().default)
+        return self._packer
+
+    def encode(self, data):
+        return base64.b64encode(self.get_packer().pack(data))
+
+    def decode(self, message):
+        try:
+            data = msgpack.unpackb(base64.b64decode(message), raw=False,
+                    object_hook=self.fallback.get_decoder().object_hook)
+        except Exception, e:
+            raise ValueError("Invalid MessagePack message: %s" % e)
+
+        if isinstance(data, list) and data:
+            # A batch of events, or a single event.
+            if isinstance(data[0], list):
+                return [self.decode_event(event) for event in data]
+            if len(data) in (2, 3):
+                return self.decode_event(data)
+        return data
+
+    def decode_event(self, data):
+        evt = {'event': self.event_names.get(data[0], data[0]), 
+                'data': data[1]}
+        if len(data) == 3:
+            evt['seq'] = data[2]
+        return evt
+
+    def encode_event(self, name, kwargs, seq=None):
+        # A sequence number is a third element.
+        if seq is None:
+            return self.encode([self.event_ids.get(name, name), kwargs])
+        return self.encode([self.event_ids.get(name, name), kwargs, seq])
+
+
+CODECS = {}
+def register_codec(name, codec):
+    """ Register a codec instance under the given name. """
+    CODECS[name] = codec
+
+
+def get_codec(codec):
+    """ 
+    Return the codec for the given registered name, import path or
+    Codec instance. 
+    """
+    if isinstance(codec, Codec):
+        return codec
+
+    try:
+        return CODECS[codec]
+    except KeyError:
+        pass
+
+    codec = get_class_or_func(codec)
+    if isinstance(codec, type):
+        codec = codec()
+    return codec
+
+
+register_codec('json', JSONCodec())
+register_codec('fastjson', FastJSONCodec())
+if msgpack is not None:
+    register_codec('msgpack', MessagePackCodec())
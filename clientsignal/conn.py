@@ -32,22 +32,136 @@ from django.utils.importlib import import_module
 from django.dispatch import Signal, receiver
 from django.utils.importlib import import_module
 from django import http
+from django.core import exceptions
 from django.contrib.auth import get_user
 from django.contrib.auth.models import User, AnonymousUser
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+
+try:
+    from django.db import close_old_connections
+except ImportError:
+    # Django < 1.6
+    from django.db import close_connection as close_old_connections
+
+import os
+import random
+
+import tornado.ioloop
+from concurrent.futures import ThreadPoolExecutor
 
 import clientsignal.settings as app_settings
-from clientsignal.utils import get_class_or_func
+from clientsignal.utils import get_class_or_func, ExpiringLRUCache
+from clientsignal.batch import add_to_batch
+from clientsignal.replay import ReplayBuffer
 
 from clientsignal.socket import EventConnection, EventHandlerMeta
+from clientsignal.socket import event, broadcast_raw
+from clientsignal.socket import SUBSCRIBE_EVENT, UNSUBSCRIBE_EVENT
+from clientsignal.socket import STREAM_EVENT, RESUME_EVENT, RESYNC_EVENT
+from clientsignal.socket import RESUMED_EVENT, RECONNECT_EVENT
+
+from collections import defaultdict
 
 import logging
 log = logging.getLogger(__name__)
 
-# Build a Django Request from the base connection info we received. This
-# should handle authentication for us through Django
-def build_request(connection_info, path = None):
-    from django.contrib.sessions.backends.db import SessionStore
-    
+MIDDLEWARE = None
+def load_middleware():
+    """ 
+    Import and instantiate the middleware in MIDDLEWARE_CLASSES, once
+    per process. Based on Django BaseHandler. Returns a list of
+    (path, instance) tuples.
+
+    Some middleware (Johnny Cache's, for example) does its work when
+    it's instantiated, so everything is loaded, whether or not it's run
+    over connection requests.
+    """
+    global MIDDLEWARE
+    if MIDDLEWARE is not None:
+        return MIDDLEWARE
+
+    log.debug("Loading middleware")
+    middleware = []
+    for middleware_path in settings.MIDDLEWARE_CLASSES:
+        try:
+            mw_module, mw_classname = middleware_path.rsplit('.', 1)
+        except ValueError:
+            raise exceptions.ImproperlyConfigured('%s isn\'t a middleware module' % middleware_path)
+        try:
+            mod = import_module(mw_module)
+        except ImportError, e:
+            raise exceptions.ImproperlyConfigured('Error importing middleware %s: "%s"' % (mw_module, e))
+        try:
+            mw_class = getattr(mod, mw_classname)
+        except AttributeError:
+            raise exceptions.ImproperlyConfigured('Middleware module "%s" does not define a "%s" class' % (mw_module, mw_classname))
+        try:
+            mw_instance = mw_class()
+        except exceptions.MiddlewareNotUsed:
+            continue
+
+        middleware.append((middleware_path, mw_instance))
+
+    MIDDLEWARE = middleware
+    return MIDDLEWARE
+
+
+SESSION_CACHE = ExpiringLRUCache(app_settings.CLIENTSIGNAL_SESSION_CACHE_SIZE,
+        app_settings.CLIENTSIGNAL_SESSION_CACHE_TTL)
+
+# Session loads that are currently running in the executor, by session
+# key, so that several connections with the same session only load it
+# once.
+PENDING_SESSIONS = {}
+
+SESSION_EXECUTOR = None
+def get_session_executor():
+    global SESSION_EXECUTOR
+    if SESSION_EXECUTOR is None:
+        SESSION_EXECUTOR = ThreadPoolExecutor(
+                max_workers=app_settings.CLIENTSIGNAL_SESSION_THREADS)
+    return SESSION_EXECUTOR
+
+
+def load_session(session_key):
+    """ 
+    Load the session with the given key and its user. This queries the
+    session and authentication backends, and so may block.
+
+    It runs on the session threads, outside of any request, so the
+    database connection is closed afterwards as it would be at the end
+    of a request, rather than left open or broken on the thread.
+    """
+    engine = import_module(settings.SESSION_ENGINE)
+    request = http.HttpRequest()
+    try:
+        request.session = engine.SessionStore(session_key=session_key)
+        request.user = get_user(request)
+    finally:
+        close_old_connections()
+    return request.session, request.user
+
+
+@receiver(user_logged_in)
+@receiver(user_logged_out)
+def invalidate_session(sender, request=None, **kwargs):
+    """ Forget the cached session and user when the user logs in or out
+    in this process.
+
+    Logins and logouts usually happen in the web processes, which can't
+    reach this cache, so connections opened in this process go on using
+    the session and user it holds for up to
+    CLIENTSIGNAL_SESSION_CACHE_TTL seconds after them; a logged out user
+    can open connections as themselves until then. Lower the TTL if
+    that's too long. """
+    session = getattr(request, 'session', None)
+    if session is not None and session.session_key:
+        SESSION_CACHE.delete(session.session_key)
+
+
+# Build a Django Request from the base connection info we received,
+# without the session or user.
+def new_request(connection_info, path=None):
     request = http.HttpRequest()
     request.path = path
     # request.path_info =
@@ -55,61 +169,149 @@ def build_request(connection_info, path = None):
     request.GET = connection_info.arguments
     request.COOKIES = http.parse_cookie(connection_info.cookies)
     request.META['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+    return request
+
+
+# Build a Django Request from the base connection info we received. This
+# should handle authentication for us through Django. This blocks if the
+# session isn't cached, build_request_async() doesn't.
+def build_request(connection_info, path = None):
+    request = new_request(connection_info, path)
 
     # Authentication
-    sessionid = request.COOKIES.get('sessionid')
-    request.session = SessionStore(session_key=sessionid)
-    request.user = get_user(request)
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    cached = SESSION_CACHE.get(session_key) if session_key else None
+    if cached is None:
+        cached = load_session(session_key)
+        if session_key:
+            SESSION_CACHE.set(session_key, cached)
+    request.session, request.user = cached
 
     return request
 
 
+# Build a Django Request as above, loading the session and user in the
+# session executor if they aren't cached, and call the callback with the
+# request on the IOLoop when it's ready.
+def build_request_async(connection_info, callback, path=None):
+    request = new_request(connection_info, path)
+
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    cached = SESSION_CACHE.get(session_key) if session_key else None
+    if cached is not None or not session_key:
+        # Without a session key there's nothing to look up.
+        request.session, request.user = cached or load_session(None)
+        callback(request)
+        return
+
+    def on_loaded(future):
+        PENDING_SESSIONS.pop(session_key, None)
+        try:
+            loaded = future.result()
+        except Exception, e:
+            log.error("Unable to load session: %s" % e)
+            loaded = load_session(None)
+        else:
+            SESSION_CACHE.set(session_key, loaded)
+
+        request.session, request.user = loaded
+        callback(request)
+
+    future = PENDING_SESSIONS.get(session_key)
+    if future is None:
+        future = get_session_executor().submit(load_session, session_key)
+        PENDING_SESSIONS[session_key] = future
+    tornado.ioloop.IOLoop.instance().add_future(future, on_loaded)
+
+
 class DjangoRequestConnection(EventConnection):
     """ 
     Connection that builds a Django request on open, allowing Django to
     handle authentication
     """
 
-    def __init__(self, *args, **kwargs):
-        super(DjangoRequestConnection, self).__init__(*args, **kwargs)
-        self.load_middleware()
+    # The middleware, from MIDDLEWARE_CLASSES, whose process_request()
+    # is run over each connection's request. Only cheap middleware that
+    # is relevant to socket connections should be listed here.
+    request_middleware = app_settings.CLIENTSIGNAL_REQUEST_MIDDLEWARE
 
     def __str__(self):
         try:
             return "<%s %s %s>" % (self.__class__.__name__,
                     self.request.user, id(self))
         except AttributeError:
-            return "<%s %s %s>" % (self.__class__.__name__,
-                    self.endpoint, id(self))
+            return "<%s %s>" % (self.__class__.__name__, id(self))
 
-    def load_middleware(self):
-        """ Based on Django BaseHandler """
-        log.debug("Loading middleware")
-        for middleware_path in settings.MIDDLEWARE_CLASSES:
-            try:
-                mw_module, mw_classname = middleware_path.rsplit('.', 1)
-            except ValueError:
-                raise exceptions.ImproperlyConfigured('%s isn\'t a middleware module' % middleware_path)
-            try:
-                mod = import_module(mw_module)
-            except ImportError, e:
-                raise exceptions.ImproperlyConfigured('Error importing middleware %s: "%s"' % (mw_module, e))
-            try:
-                mw_class = getattr(mod, mw_classname)
-            except AttributeError:
-                raise exceptions.ImproperlyConfigured('Middleware module "%s" does not define a "%s" class' % (mw_module, mw_classname))
+    @classmethod
+    def get_request_middleware(cls):
+        """ Return the process_request() methods to run for this
+        class's connections. These are looked up once per class. """
+        if '_request_middleware' not in cls.__dict__:
+            cls._request_middleware = [mw.process_request
+                    for path, mw in load_middleware()
+                    if path in cls.request_middleware and
+                        hasattr(mw, 'process_request')]
+        return cls._request_middleware
+
+    def process_request(self, request):
+        """ Run the request middleware over the request. Returns False
+        if the middleware rejected it. """
+        for process_request in self.get_request_middleware():
             try:
-                mw_instance = mw_class()
-            except exceptions.MiddlewareNotUsed:
-                continue
+                response = process_request(request)
+            except Exception, e:
+                log.error("Middleware %s failed for %s: %s" % 
+                        (process_request, self, e))
+                return False
+
+            if response is not None:
+                # The middleware has answered the request itself, which
+                # we can't send to a socket.
+                log.info("Middleware %s rejected %s" % 
+                        (process_request, self))
+                return False
 
-            # We're not going to do anything else for now... 
+        return True
 
     def on_open(self, connection_info):
-        self.request = build_request(connection_info)
+        # The request is built asynchronously. Until it's ready
+        # self.request is None, and messages from the client are held.
+        self.request = None
+        self._held_messages = []
+        build_request_async(connection_info, self._on_request_built)
+
+    def _on_request_built(self, request):
+        if self.is_closed:
+            return
+
+        self.request = request
         log.info("Opened " + str(self))
+
+        if not self.process_request(request) or \
+                self.on_request(request) is False:
+            self.close()
+            return
+
+        held, self._held_messages = self._held_messages, None
+        for message in held:
+            self.on_message(message)
+
+    def on_request(self, request):
+        """ 
+        Called once the Django request for this connection has been
+        built, including its session and user. Return False to close the
+        connection.
+        """
+        pass
+
+    def on_message(self, message):
+        if self.request is None:
+            self._held_messages.append(message)
+            return
+        super(DjangoRequestConnection, self).on_message(message)
            
     def on_close(self):
+        super(DjangoRequestConnection, self).on_close()
         log.info("Closed " + str(self))
 
 
@@ -118,6 +320,12 @@ class SignalHandlerMeta(EventHandlerMeta):
         # Set the _events dictionary for lookup.
         setattr(cls, '_broadcast_signals', dict())
         setattr(cls, '_listen_signals', dict())
+        # The open connections of this class (not including subclasses).
+        setattr(cls, '_connections', set())
+        # Topic -> the open connections subscribed to it.
+        setattr(cls, '_topics', defaultdict(set))
+        # User id -> the open connections of that user.
+        setattr(cls, '_users', defaultdict(set))
         super(SignalHandlerMeta, cls).__init__(name, bases, attrs)
 
 
@@ -134,6 +342,15 @@ class BaseSignalConnection(DjangoRequestConnection):
 
     clients = set()
 
+    # Set while the server drains before exiting (see runsocket), when new
+    # sessions are closed as soon as they open.
+    draining = False
+
+    # Broadcasts to this class's clients are numbered, and the last
+    # replay_size of them kept, so that clients that reconnect can be
+    # sent the ones they missed. 0 turns this off.
+    replay_size = app_settings.CLIENTSIGNAL_REPLAY_SIZE
+
     @classmethod
     def listen(cls, name, signal):
         """ Register the given signal with the given name to be recieved
@@ -146,9 +363,14 @@ class BaseSignalConnection(DjangoRequestConnection):
         cls.register_signal(name, signal, listen=True)
 
     @classmethod
-    def broadcast(cls, name, signal):
+    def broadcast(cls, name, signal, max_queue=None, policy=None,
+            coalesce_key=None):
         """ Register the given signal with the given name to be sent to
-        client receivers. """
+        client receivers. 
+        
+        max_queue, policy and coalesce_key optionally limit how many of
+        these signals may be queued for a client that isn't keeping up
+        (see EventConnection.set_queue_limit()). """
         
         # Register the signal with the connection so that the given
         # Django signal is sent to the client as an event with the given
@@ -156,6 +378,10 @@ class BaseSignalConnection(DjangoRequestConnection):
         # log.info("Broadcasting signal " + name)
         cls.register_signal(name, signal, broadcast=True)
 
+        if max_queue is not None or policy is not None or \
+                coalesce_key is not None:
+            cls.set_queue_limit(name, max_queue, policy, coalesce_key)
+
     @classmethod
     def register(cls, name, signal):
         """
@@ -168,6 +394,11 @@ class BaseSignalConnection(DjangoRequestConnection):
         # log.info("Registering signal " + name + " for class " + unicode(cls))
         cls.register_signal(name, signal, listen=True, broadcast=True)
 
+    @classmethod
+    def get_event_names(cls):
+        return set(super(BaseSignalConnection, cls).get_event_names()) | \
+                set(cls._broadcast_signals) | set(cls._listen_signals)
+
     @classmethod
     def register_signal(cls, name, signal, listen=False, broadcast=False):
         """ 
@@ -193,18 +424,297 @@ class BaseSignalConnection(DjangoRequestConnection):
         log.debug("Sending signal named " + name)
         self.send(name, **kwargs)
 
+    @classmethod
+    def send_broadcast(cls, name, kwargs, exclude=None, topic=None):
+        """
+        Send the signal with the given name and kwargs to every open
+        connection of this class, or only those subscribed to the topic
+        if one is given, except for exclude. The event is encoded and
+        framed once for all of the connections.
+        """
+        log.debug("Broadcasting signal named " + name)
+        if topic is None:
+            connections = cls._connections
+        else:
+            connections = cls._topics.get(topic, ())
+
+        cls.deliver(connections, name, kwargs, topic=topic, 
+                exclude=exclude)
+
+    @classmethod
+    def deliver(cls, connections, name, kwargs=None, encoded=None, 
+            topic=None, exclude=None, replay=True):
+        """
+        Send an event to the given connections of this class, except for
+        exclude. Either its kwargs or the event already encoded with the
+        class's codec, or both, must be given; it's only encoded (or
+        decoded) if it has to be. Broadcasts (replay=True) are numbered
+        and kept for replay, whether or not there's anyone to send them
+        to.
+        """
+        seq = None
+        if replay and cls.replay_size:
+            seq = cls.get_replay_buffer().add(name, kwargs, encoded, topic)
+
+        clients = [c for c in connections if c is not exclude]
+        if not clients:
+            return 0
+
+        codec = cls._codec
+        if cls.binary_codec is None:
+            by_codec = {codec: clients}
+        else:
+            by_codec = defaultdict(list)
+            for conn in clients:
+                by_codec[conn._codec].append(conn)
+
+        # Coalescing queued messages needs the event's kwargs, and so
+        # does re-encoding it for clients using another codec.
+        if kwargs is None:
+            limit = cls.get_queue_limit(name)
+            if len(by_codec) > 1 or codec not in by_codec or \
+                    (limit is not None and limit.coalesce_key is not None):
+                kwargs = codec.decode(encoded)['data']
+
+        sent = 0
+        for conn_codec, codec_clients in by_codec.items():
+            if conn_codec is codec and encoded is not None:
+                raw_data = encoded
+                if seq is not None:
+                    raw_data = codec.add_sequence(encoded, seq)
+            else:
+                raw_data = conn_codec.encode_event(name, kwargs, seq)
+            sent += broadcast_raw(codec_clients, raw_data, name, kwargs)
+        return sent
+
+    @classmethod
+    def get_replay_buffer(cls):
+        """ This class's ReplayBuffer in this process. """
+        buf = cls.__dict__.get('_replay_buffer')
+        if buf is None or buf.pid != os.getpid():
+            # Forked children number their own broadcasts.
+            buf = cls._replay_buffer = ReplayBuffer(cls.replay_size)
+        return buf
+
+    def replay(self, epoch, seq):
+        """
+        Send this connection the broadcasts it missed after the given
+        sequence number, or RESYNC_EVENT if they aren't all available.
+        """
+        try:
+            seq = int(seq)
+        except (TypeError, ValueError):
+            seq = None
+
+        missed = None
+        if self.replay_size and seq is not None:
+            missed = self.get_replay_buffer().missed(epoch, seq, 
+                    self.topics)
+
+        if missed is None:
+            log.debug("%s must resync from %s" % (self, seq))
+            self.send(RESYNC_EVENT)
+        else:
+            codec = self.__class__._codec
+            for evt in missed:
+                kwargs = evt.kwargs
+                if self._codec is codec and evt.encoded is not None:
+                    raw_data = codec.add_sequence(evt.encoded, evt.seq)
+                else:
+                    if kwargs is None:
+                        kwargs = codec.decode(evt.encoded)['data']
+                    raw_data = self._codec.encode_event(evt.name, kwargs, 
+                            evt.seq)
+                self.send_raw(raw_data, evt.name, kwargs)
+
+        # Broadcasts sent to this connection since it opened may have
+        # been sent live as well, before this or still to come (from the
+        # fan-out queue). Tell the client where the replay got to, so
+        # that it can drop the copies.
+        if self.replay_size:
+            buf = self.get_replay_buffer()
+            self.send(RESUMED_EVENT, epoch=buf.epoch, seq=buf.seq)
+
+    @classmethod
+    def publish(cls, name, kwargs):
+        """ Send the broadcast signal with the given name and kwargs to
+        the clients of this class, in every process the backend reaches.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def publish_many(cls, events):
+        """ Send a batch of (name, kwargs) broadcast signals. """
+        for name, kwargs in events:
+            cls.publish(name, kwargs)
+
+    def can_subscribe(self, topic):
+        """ Whether this connection may subscribe to the given topic. 
+        Topics can carry one user's or object's data, so none are
+        allowed unless a subclass overrides this to allow them. """
+        return False
+
+    def subscribe(self, topic):
+        """ Subscribe this connection to signals sent with the given
+        topic. """
+        if topic in self.topics:
+            return
+
+        self.topics.add(topic)
+        connections = self._topics[topic]
+        connections.add(self)
+        if len(connections) == 1:
+            self.topic_added(topic)
+
+    def unsubscribe(self, topic):
+        """ Unsubscribe this connection from the given topic. """
+        if topic not in self.topics:
+            return
+
+        self.topics.discard(topic)
+        connections = self._topics.get(topic)
+        if connections is not None:
+            connections.discard(self)
+            if not connections:
+                del self._topics[topic]
+                self.topic_removed(topic)
+
+    @classmethod
+    def topic_added(cls, topic):
+        """ Called when a topic gets its first subscriber in this
+        process. """
+        pass
+
+    @classmethod
+    def topic_removed(cls, topic):
+        """ Called when a topic loses its last subscriber in this
+        process. """
+        pass
+
+    @classmethod
+    def send_to_user(cls, user_id, name, **kwargs):
+        """
+        Send the event with the given name and kwargs to every open 
+        connection of the user with the given id.
+        """
+        # These aren't broadcasts, so aren't numbered or replayed.
+        cls.deliver(cls._users.get(user_id, ()), name, kwargs, 
+                replay=False)
+
+    def _add_user(self):
+        user = getattr(self.request, 'user', None)
+        if user is None or not user.is_authenticated():
+            return
+
+        self.user_id = user.pk
+        connections = self._users[self.user_id]
+        connections.add(self)
+        if len(connections) == 1:
+            self.user_added(self.user_id)
+
+    def _remove_user(self):
+        if self.user_id is None:
+            return
+
+        connections = self._users.get(self.user_id)
+        if connections is not None:
+            connections.discard(self)
+            if not connections:
+                del self._users[self.user_id]
+                self.user_removed(self.user_id)
+        self.user_id = None
+
+    @classmethod
+    def user_added(cls, user_id):
+        """ Called when a user opens their first connection in this
+        process. """
+        pass
+
+    @classmethod
+    def user_removed(cls, user_id):
+        """ Called when a user closes their last connection in this
+        process. """
+        pass
+
+    def reconnect(self, delay=0, url=None):
+        """ Ask the client to reconnect after delay milliseconds, to the
+        given URL (another server's, say) or else to the same one. It
+        stays connected to this one until then. """
+        if url is None:
+            self.send(RECONNECT_EVENT, delay=int(delay))
+        else:
+            self.send(RECONNECT_EVENT, delay=int(delay), url=url)
+
+    @classmethod
+    def reconnect_all(cls, window=0, url=None):
+        """ Ask every open connection of this class to reconnect, each
+        after a random delay of up to window milliseconds, so that they
+        don't all come back at once. """
+        connections = list(cls._connections)
+        for conn in connections:
+            conn.reconnect(random.uniform(0, window), url)
+        return len(connections)
+
+    @event(SUBSCRIBE_EVENT)
+    def on_subscribe(self, topic=None, **kwargs):
+        if topic is not None and self.can_subscribe(topic):
+            self.subscribe(topic)
+        else:
+            log.info("%s may not subscribe to %s" % (self, topic))
+
+    @event(UNSUBSCRIBE_EVENT)
+    def on_unsubscribe(self, topic=None, **kwargs):
+        self.unsubscribe(topic)
+
+    @event(RESUME_EVENT)
+    def on_resume(self, epoch=None, seq=None, **kwargs):
+        # Sent by a reconnecting client, after subscribing to its
+        # topics, with the last sequence number it saw.
+        self.replay(epoch, seq)
+
     def on_open(self, connection_info):
-        super(BaseSignalConnection, self).on_open(connection_info)
+        self.topics = set()
+        self.user_id = None
+        # Registered first, because the request may be built (from the
+        # session cache) and on_request() close the connection before
+        # super() returns, and on_close() unregisters it.
         self.clients.add(self)
+        self._connections.add(self)
+        super(BaseSignalConnection, self).on_open(connection_info)
+        if self.draining and not self.is_closed:
+            # Have the client try again, on another server.
+            self.close()
+
+    def _on_request_built(self, request):
+        super(BaseSignalConnection, self)._on_request_built(request)
+        # Index the connection by its user, once we know who that is.
+        if not self.is_closed:
+            self._add_user()
+
+            # Tell the client which stream its broadcasts' sequence
+            # numbers belong to, and where it's up to.
+            if self.replay_size:
+                buf = self.get_replay_buffer()
+                self.send(STREAM_EVENT, epoch=buf.epoch, seq=buf.seq)
 
     def on_close(self):
         super(BaseSignalConnection, self).on_close()
-        self.clients.remove(self)
+        self.clients.discard(self)
+        self._connections.discard(self)
+        self._remove_user()
+        for topic in list(self.topics):
+            self.unsubscribe(topic)
 
     
 class SimpleSignalConnection(BaseSignalConnection):
 
-    _listeners = {}
+    @classmethod
+    def publish(cls, name, kwargs):
+        # If the sender is a connection (i.e. the signal was received
+        # over that connection) don't send it back. Signals sent with a
+        # topic only go to its subscribers.
+        cls.send_broadcast(name, kwargs, exclude=kwargs.get('sender'),
+                topic=kwargs.get('topic'))
 
     @classmethod
     def register_signal(cls, name, signal, listen=False, broadcast=False):
@@ -219,41 +729,25 @@ class SimpleSignalConnection(BaseSignalConnection):
                 signal.send(conn.request.user, **kwargs)
 
             cls._events[name] = handler
-    
-    def on_open(self, connection_info):
-        super(SimpleSignalConnection, self).on_open(connection_info)
 
-        # Generate a listener function for the given signal with the
-        # given name and return it. That function will handle sending 
-        # the signal as an event on this connection.
-        def listener_factory(name, signal):
+        if broadcast:
+            # A single receiver for this class and signal sends the
+            # signal on to all of the class's open connections, rather
+            # than each connection connecting its own receiver.
             def listener(sender, **kwargs):
                 # Remove the 'signal' object from the kwargs, it's not
                 # serializable, and we don't need it.
                 del kwargs['signal']
                 kwargs['sender'] = sender
 
-                # If the sender is NOT this connection (i.e. the signal
-                # was received over this connection or send it on.
-                if sender != self:
-                    self.send_signal(name, **kwargs)
-            
-            return listener
-
-        # Receive the signal within Django and send it to the client as a
-        # event.
-        for name, signal in self._broadcast_signals.items():
-            listener = listener_factory(name, signal)
-            self._listeners[name] = listener
-            # We don't want a weakref to the handler function, we don't
-            # want it garbage collected.
-            signal.connect(listener, weak=False)
-
-    def on_close(self):
-        # Disconnect signals that this connection was listening to.
-        for name, signal in self._broadcast_signals.items():
-            listener = self._listeners[name]
-            signal.disconnect(listener, weak=False)
-
-        super(SimpleSignalConnection, self).on_close();
+                # Inside batched_broadcasts() the signal is held and
+                # sent with the rest of the batch.
+                if not add_to_batch(cls, name, kwargs):
+                    cls.publish(name, kwargs)
 
+            # We don't want a weakref to the handler function, we don't
+            # want it garbage collected. The dispatch_uid keeps us from
+            # connecting twice if the signal is registered again.
+            signal.connect(listener, weak=False,
+                    dispatch_uid="%s.%s:%s" % (cls.__module__,
+                        cls.__name__, name))
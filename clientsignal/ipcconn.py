@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Will Barton.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright 
+#      notice, this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright 
+#      notice, this list of conditions and the following disclaimer in the 
+#      documentation and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL
+# THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# A backend for several socket server processes on one host, such as
+# runsocket --workers, that brokers messages over a Unix domain socket
+# rather than through Redis. The first process to need it binds the
+# socket and runs the broker on its IOLoop; every process (including
+# that one) connects to it, and subscribes and publishes like it would
+# with Redis. If the broker's process dies the others reconnect, and
+# one of them takes over.
+#
+#   CLIENTSIGNAL_BACKEND = 'ipc:///var/run/clientsignal.sock'
+#
+# Frames on the socket are a 4 byte length, a command byte ('S'
+# subscribe, 'U' unsubscribe, 'P' publish), a 4 byte channel length,
+# the channel, and for 'P' the message.
+
+# Don't import clientsignal.socket as socket.
+from __future__ import absolute_import
+
+import os
+import errno
+import fcntl
+import socket
+import struct
+import threading
+import urlparse
+from collections import defaultdict
+
+import tornado.ioloop
+import tornado.iostream
+import tornado.tcpserver
+
+import clientsignal.settings as app_settings
+from clientsignal.backend import Subscriber, BackendSignalConnection
+from clientsignal.backend import Backoff
+from clientsignal.utils import ioloop_running
+
+import logging
+log = logging.getLogger(__name__)
+
+IPC_PATH = urlparse.urlparse(app_settings.CLIENTSIGNAL_BACKEND).path
+
+SUBSCRIBE = 'S'
+UNSUBSCRIBE = 'U'
+PUBLISH = 'P'
+
+HEADER = struct.Struct('!IcI')
+
+
+def encode_frame(command, channel, message=''):
+    if isinstance(channel, unicode):
+        channel = channel.encode('utf-8')
+    return HEADER.pack(HEADER.size - 4 + len(channel) + len(message), 
+            command, len(channel)) + channel + message
+
+
+def decode_frame(frame):
+    """ Return the command, channel and message of a frame, without its
+    leading length. """
+    command, length = struct.unpack('!cI', frame[:5])
+    return command, frame[5:5 + length], frame[5 + length:]
+
+
+class FrameReader(object):
+    """ Read frames from an IOStream, calling on_frame(stream, frame) 
+    with each. """
+
+    def __init__(self, stream, on_frame):
+        self.stream = stream
+        self.on_frame = on_frame
+        self.read_header()
+
+    def read_header(self):
+        if not self.stream.closed():
+            self.stream.read_bytes(4, self.on_header)
+
+    def on_header(self, data):
+        length, = struct.unpack('!I', data)
+        self.stream.read_bytes(length, self.on_body)
+
+    def on_body(self, data):
+        try:
+            self.on_frame(self.stream, data)
+        except Exception, e:
+            log.exception("Error handling IPC frame: %s" % e)
+        self.read_header()
+
+
+class IPCBroker(tornado.tcpserver.TCPServer):
+    """ 
+    Relays published frames to the connected processes subscribed to 
+    their channel. 
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(IPCBroker, self).__init__(*args, **kwargs)
+        # Channel -> subscribed streams.
+        self.channels = defaultdict(set)
+        # Stream -> its channels.
+        self.subscriptions = defaultdict(set)
+
+    def handle_stream(self, stream, address):
+        stream.set_close_callback(lambda: self.on_stream_close(stream))
+        FrameReader(stream, self.on_frame)
+
+    def on_frame(self, stream, frame):
+        command, channel, message = decode_frame(frame)
+        if command == PUBLISH:
+            subscribers = self.channels.get(channel)
+            if subscribers:
+                data = struct.pack('!I', len(frame)) + frame
+                for subscriber in subscribers:
+                    if not subscriber.closed():
+                        subscriber.write(data)
+        elif command == SUBSCRIBE:
+            self.channels[channel].add(stream)
+            self.subscriptions[stream].add(channel)
+        elif command == UNSUBSCRIBE:
+            self.remove(stream, channel)
+
+    def remove(self, stream, channel):
+        self.subscriptions[stream].discard(channel)
+        subscribers = self.channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(stream)
+            if not subscribers:
+                del self.channels[channel]
+
+    def on_stream_close(self, stream):
+        for channel in list(self.subscriptions.pop(stream, ())):
+            self.remove(stream, channel)
+
+
+def bind_broker_socket(path, backlog=128):
+    """ Bind the broker's socket, or return None if another process's
+    broker is already listening on it. A socket left behind by a broker
+    that has gone away is replaced. 
+    
+    Processes taking over at once would unlink each other's sockets,
+    and each start a broker the others can't reach, so this holds a lock
+    on path + '.lock' until the socket is listening. """
+    lock = open(path + '.lock', 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        try:
+            sock.bind(path)
+        except socket.error, e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                # Nobody's listening.
+                os.unlink(path)
+                sock.bind(path)
+            else:
+                sock.close()
+                return None
+            finally:
+                probe.close()
+
+        sock.listen(backlog)
+        return sock
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+BROKER = None
+def start_ipc_broker():
+    """ Start the broker in this process if no process has one. """
+    global BROKER
+    if BROKER is not None:
+        return BROKER
+
+    sock = bind_broker_socket(IPC_PATH)
+    if sock is not None:
+        log.info("Starting IPC broker on %s" % IPC_PATH)
+        BROKER = IPCBroker()
+        BROKER.add_socket(sock)
+    return BROKER
+
+
+class IPCSubscriber(Subscriber):
+    """
+    This process's connection to the broker, on the IOLoop, which it
+    subscribes and publishes over.
+    """
+
+    def __init__(self):
+        super(IPCSubscriber, self).__init__()
+        self.stream = None
+        self.reconnecting = False
+        self.backoff = Backoff()
+
+    def connect(self):
+        if self.stream is not None:
+            return
+
+        start_ipc_broker()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.stream = tornado.iostream.IOStream(sock)
+        self.stream.set_close_callback(self.on_close)
+        # Writes are buffered until the stream connects.
+        stream = self.stream
+        self.stream.connect(IPC_PATH, lambda: self.on_connect(stream))
+
+    def on_connect(self, stream):
+        self.backoff.reset()
+        FrameReader(stream, self.on_frame)
+
+    def send(self, data):
+        self.connect()
+        self.stream.write(data)
+
+    def subscribe(self, channel):
+        log.debug("Subscribing to IPC channel %s" % channel)
+        self.send(encode_frame(SUBSCRIBE, channel))
+
+    def unsubscribe(self, channel):
+        if self.stream is None:
+            return
+
+        log.debug("Unsubscribing from IPC channel %s" % channel)
+        self.send(encode_frame(UNSUBSCRIBE, channel))
+
+    def on_frame(self, stream, frame):
+        command, channel, message = decode_frame(frame)
+        if command == PUBLISH:
+            self.on_channel_message(channel, message)
+
+    def on_close(self):
+        log.error("Lost connection to the IPC broker")
+        self.stream = None
+        self.on_lost()
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if self.reconnecting:
+            return
+
+        self.reconnecting = True
+        delay = self.backoff.next()
+        log.info("Reconnecting to the IPC broker in %ss" % delay)
+        io_loop = tornado.ioloop.IOLoop.instance()
+        io_loop.add_timeout(io_loop.time() + delay, self.reconnect)
+
+    def reconnect(self):
+        self.reconnecting = False
+        try:
+            self.connect()
+            self.resubscribe()
+        except Exception, e:
+            # Starting a broker, say, failed. Try again later.
+            log.error("Unable to reconnect to the IPC broker: %s" % e)
+            stream, self.stream = self.stream, None
+            if stream is not None:
+                stream.set_close_callback(None)
+                stream.close()
+            self.schedule_reconnect()
+
+
+SUBSCRIBER = None
+def get_ipc_subscriber():
+    global SUBSCRIBER
+    if SUBSCRIBER is None:
+        SUBSCRIBER = IPCSubscriber()
+    return SUBSCRIBER
+
+
+class IPCPublisher(object):
+    """ Publishes over this process's connection to the broker, on the
+    IOLoop. """
+
+    def publish(self, channel, message):
+        get_ipc_subscriber().send(encode_frame(PUBLISH, channel, message))
+
+    def publish_many(self, messages):
+        # One write for the batch.
+        get_ipc_subscriber().send(''.join(
+            encode_frame(PUBLISH, channel, message)
+            for channel, message in messages))
+
+
+class SyncIPCPublisher(threading.local):
+    """
+    Publishes to the broker from code that isn't running on an IOLoop,
+    like Django's WSGI workers or Celery on the same host, with a 
+    blocking socket for each thread.
+    """
+
+    sock = None
+
+    def send(self, data):
+        for attempt in range(2):
+            try:
+                if self.sock is None:
+                    self.sock = socket.socket(socket.AF_UNIX, 
+                            socket.SOCK_STREAM)
+                    self.sock.connect(IPC_PATH)
+                self.sock.sendall(data)
+                return
+            except socket.error, e:
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+        log.error("Cannot publish to the IPC broker: %s" % e);
+
+    def publish(self, channel, message):
+        self.send(encode_frame(PUBLISH, channel, message))
+
+    def publish_many(self, messages):
+        self.send(''.join(encode_frame(PUBLISH, channel, message)
+            for channel, message in messages))
+
+
+PUBLISHER = None
+SYNC_PUBLISHER = None
+def get_ipc_publisher():
+    """ The publisher to use in this thread. """
+    global PUBLISHER, SYNC_PUBLISHER
+    if not ioloop_running():
+        if SYNC_PUBLISHER is None:
+            SYNC_PUBLISHER = SyncIPCPublisher()
+        return SYNC_PUBLISHER
+
+    if PUBLISHER is None:
+        PUBLISHER = IPCPublisher()
+    return PUBLISHER
+
+
+class IPCSignalConnection(BackendSignalConnection):
+    """
+    A signal connection that publishes its broadcast signals through the
+    IPC broker, reaching the connections in every process on this host.
+    """
+
+    @classmethod
+    def get_publisher(cls):
+        return get_ipc_publisher()
+
+    @classmethod
+    def get_subscriber(cls):
+        return get_ipc_subscriber()
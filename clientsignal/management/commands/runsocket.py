@@ -3,7 +3,13 @@
 # Losely based on django.core.management.commands.runserver
 
 import sys
+import os
+import errno
 import os.path
+import math
+import random
+import signal
+import socket
 import logging
 from datetime import datetime
 from optparse import make_option
@@ -17,14 +23,163 @@ from django.utils import autoreload
 
 import tornado
 import tornado.wsgi
+import tornado.netutil
+import tornado.process
 import tornado.httpserver
 
 from clientsignal import settings as app_settings
-from clientsignal import SignalConnection
+from clientsignal import SignalConnection, SimpleSignalConnection
+from clientsignal import BaseSignalConnection
 from clientsignal.utils import get_class_or_func, get_socket_urls
 
 DEFAULT_PORT = "8000"
 
+# The listen backlog, as Tornado uses by default.
+DEFAULT_BACKLOG = 128
+
+
+def bind_reuseport_socket(port, backlog):
+    """ Bind a listening socket for the port with SO_REUSEPORT, so that
+    each worker can bind its own and the kernel balances connections
+    between them. """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setblocking(0)
+    sock.bind(('', int(port)))
+    sock.listen(backlog)
+    return [sock]
+
+
+class Drain(object):
+    """
+    Move this process's clients to other servers before it exits. The
+    server stops accepting connections, and new sessions on connections
+    it already has are closed. The open connections are asked to
+    reconnect in batches, one a second, spread over period seconds, and
+    the process exits once threshold or fewer remain, or grace seconds
+    after the last batch (closing whatever is left). Starting it again
+    does nothing; interrupt the process to stop it at once.
+    """
+
+    # Seconds between batches.
+    interval = 1
+
+    # Seconds to wait for the last clients after the last batch.
+    grace = 10
+
+    def __init__(self, server, period, threshold=0):
+        self.server = server
+        self.period = period
+        self.threshold = threshold
+        self.pending = None
+        self.callback = None
+
+    @property
+    def draining(self):
+        return self.pending is not None
+
+    def start(self):
+        if self.draining:
+            return
+
+        io_loop = tornado.ioloop.IOLoop.instance()
+        self.server.stop()
+        BaseSignalConnection.draining = True
+
+        self.pending = list(BaseSignalConnection.clients)
+        random.shuffle(self.pending)
+        batches = max(1, int(math.ceil(self.period / self.interval)))
+        self.batch_size = int(math.ceil(len(self.pending) / 
+                float(batches)))
+        self.deadline = io_loop.time() + batches * self.interval + \
+                self.grace
+        logging.info("Draining %s connections over %ss" % 
+                (len(self.pending), self.period))
+
+        self.callback = tornado.ioloop.PeriodicCallback(self.tick, 
+                self.interval * 1000)
+        self.callback.start()
+        self.tick()
+
+    def tick(self):
+        io_loop = tornado.ioloop.IOLoop.instance()
+        batch = self.pending[:self.batch_size]
+        del self.pending[:self.batch_size]
+        for conn in batch:
+            if not conn.is_closed:
+                # Spread each batch over its interval too.
+                conn.reconnect(delay=random.uniform(0, 
+                    self.interval * 1000))
+
+        remaining = len(BaseSignalConnection.clients)
+        if remaining <= self.threshold or io_loop.time() >= self.deadline:
+            logging.info("Drained, closing %s remaining connections" % 
+                    remaining)
+            self.callback.stop()
+            for conn in list(BaseSignalConnection.clients):
+                conn.close()
+            # Let the closes be written.
+            io_loop.add_callback(io_loop.stop)
+
+
+# What the parent tells a worker over its pipe when it's sent SIGTERM
+# or SIGINT.
+WORKER_DRAIN = 'd'
+WORKER_STOP = 's'
+
+
+def set_nonblocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def make_worker_pipes(workers):
+    """ A pipe for the parent to tell each worker to drain or stop. 
+    (Signalling the process group would reach whatever started us 
+    too.) """
+    pipes = [os.pipe() for i in range(workers)]
+    for read_fd, write_fd in pipes:
+        set_nonblocking(write_fd)
+    return pipes
+
+
+def tell_workers(pipes, command):
+    """ A signal handler for the parent that passes the command on to
+    every worker. The parent carries on waiting for them, and exits once
+    they have. """
+    def handler(signum, frame):
+        for read_fd, write_fd in pipes:
+            try:
+                os.write(write_fd, command)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+    return handler
+
+
+def watch_worker_pipe(fd, drain=None):
+    """ Drain, or stop if there's no drain or the parent says to, when 
+    the parent writes to the worker's pipe. """
+    io_loop = tornado.ioloop.IOLoop.instance()
+
+    def on_read(fd, events):
+        try:
+            commands = os.read(fd, 64)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        if WORKER_STOP in commands or drain is None:
+            io_loop.stop()
+        elif WORKER_DRAIN in commands:
+            drain.start()
+
+    set_nonblocking(fd)
+    io_loop.add_handler(fd, on_read, io_loop.READ)
+
+
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option('--reload', 
@@ -42,6 +197,35 @@ class Command(BaseCommand):
             dest='use_static', 
             default=False,
             help="Serve static files (requires --django)."),
+        make_option('--workers', 
+            type='int',
+            dest='workers', 
+            default=1,
+            help="Fork this many worker processes (0 for one per CPU). "
+                 "Requires a cross-process backend."),
+        make_option('--backlog', 
+            type='int',
+            dest='backlog', 
+            default=DEFAULT_BACKLOG,
+            help="The listen backlog for each port."),
+        make_option('--reuseport', 
+            action='store_true',
+            dest='reuseport', 
+            default=False,
+            help="Have each worker bind its own sockets with "
+                 "SO_REUSEPORT, rather than sharing the parent's."),
+        make_option('--drain-period', 
+            type='float',
+            dest='drain_period', 
+            default=30,
+            help="On SIGTERM, ask clients to reconnect elsewhere over "
+                 "this many seconds before exiting (0 exits at once)."),
+        make_option('--drain-threshold', 
+            type='int',
+            dest='drain_threshold', 
+            default=0,
+            help="Exit once this many or fewer clients remain while "
+                 "draining."),
     )
     help = "Starts a Tornado/SockJS Socket Server."
     args = '[optional port number] (multiple starts multiple servers)'
@@ -64,8 +248,32 @@ class Command(BaseCommand):
         self.ports = ports
         settings.CLIENTSIGNAL_CURRENT_PORTS = ports
 
+        workers = options.get('workers', 1)
+        if workers != 1:
+            if options.get('use_reloader', False):
+                raise CommandError("--reload can't be used with --workers.")
+            self.check_backend()
+
+        if options.get('reuseport', False) and \
+                not hasattr(socket, 'SO_REUSEPORT'):
+            raise CommandError("SO_REUSEPORT isn't available here.")
+
         self.run(**options)
 
+    def check_backend(self):
+        """ Make sure every socket connection can reach clients in other
+        processes. """
+        if not app_settings.CLIENTSIGNAL_BACKEND:
+            raise CommandError("--workers requires a cross-process "
+                    "backend, set with CLIENTSIGNAL_BACKEND.")
+
+        for url, conn in app_settings.CLIENTSIGNAL_CONNECTIONS.items():
+            conn_cls = get_class_or_func(conn)
+            if issubclass(conn_cls, SimpleSignalConnection):
+                raise CommandError(("%s (%s) only reaches clients in its "
+                    "own process, and can't be used with --workers.") % 
+                    (conn, url))
+
 
     def run(self, **options):
         """
@@ -95,6 +303,44 @@ class Command(BaseCommand):
 
         base_port = self.ports[0]
 
+        # Bind the ports before forking so that the workers share them.
+        # Nothing may touch the IOLoop before the fork; the routers and
+        # everything else are created in each worker.
+        workers = options.get('workers', 1)
+        backlog = options.get('backlog', DEFAULT_BACKLOG)
+        reuseport = options.get('reuseport', False)
+        sockets = []
+        if not reuseport:
+            for port in self.ports:
+                sockets.extend(tornado.netutil.bind_sockets(port, 
+                    backlog=backlog))
+
+        drain_period = options.get('drain_period', 30)
+        worker_pipe = None
+        if workers != 1:
+            workers = workers or tornado.process.cpu_count()
+            self.stdout.write("Starting %s workers...\n" % workers)
+            # The workers drain (or stop, with no drain period) when the
+            # parent is sent SIGTERM, and stop when it's sent SIGINT.
+            pipes = make_worker_pipes(workers)
+            signal.signal(signal.SIGTERM, 
+                    tell_workers(pipes, WORKER_DRAIN))
+            signal.signal(signal.SIGINT, 
+                    tell_workers(pipes, WORKER_STOP))
+            # The parent stays here, restarting workers that die, until
+            # they have all exited normally.
+            tornado.process.fork_processes(workers)
+
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            worker_pipe = pipes[tornado.process.task_id()][0]
+            for read_fd, write_fd in pipes:
+                os.close(write_fd)
+
+        if reuseport:
+            for port in self.ports:
+                sockets.extend(bind_reuseport_socket(port, backlog))
+
         tornado_urls = get_socket_urls()
 
         use_django = options.get('use_django', False)
@@ -124,9 +370,20 @@ class Command(BaseCommand):
             server = tornado.httpserver.HTTPServer(application, 
                     io_loop=io_loop)
 
-            # Add the remainder of ports.
-            for port in self.ports:
-                server.listen(port)
+            server.add_sockets(sockets)
+
+            drain = None
+            if drain_period > 0:
+                drain = Drain(server, drain_period, 
+                        options.get('drain_threshold', 0))
+                signal.signal(signal.SIGTERM, lambda signum, frame:
+                        io_loop.add_callback_from_signal(drain.start))
+            if worker_pipe is not None:
+                watch_worker_pipe(worker_pipe, drain)
+                if drain is None:
+                    # Exit normally, or the parent would restart us.
+                    signal.signal(signal.SIGTERM, lambda signum, frame:
+                            io_loop.add_callback_from_signal(io_loop.stop))
 
             self.stdout.write((
                 "%(started_at)s\n"
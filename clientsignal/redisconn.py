@@ -27,16 +27,23 @@
 # ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import time
+import threading
+from collections import deque, Counter
+from functools import partial
+
 import tornado
+import tornado.ioloop
+import tornado.stack_context
 
 import redis
 import tornadoredis
 
 import clientsignal.settings as app_settings
-from clientsignal.conn import BaseSignalConnection
-from clientsignal.socket import encode_event
+from clientsignal.backend import Subscriber, BackendSignalConnection
+from clientsignal.backend import Backoff
 
-from clientsignal.utils import get_class_or_func
+from clientsignal.utils import get_class_or_func, ioloop_running
 from clientsignal.utils import get_backend_url_parts
 
 import logging
@@ -45,6 +52,29 @@ log = logging.getLogger(__name__)
 # Redis pool
 REDIS_URL = get_backend_url_parts(app_settings.CLIENTSIGNAL_BACKEND)
 
+
+def get_redis_args(url_parts):
+    """ The host, port, db and password to connect to Redis with, from 
+    the parts of a backend URL, as keyword arguments for redis-py. """
+    return {
+        'host': url_parts.get('host') or 'localhost',
+        'port': url_parts.get('port') or 6379,
+        'db': int(url_parts.get('path') or 0),
+        'password': url_parts.get('password') or None,
+    }
+
+
+def get_tornadoredis_args(url_parts):
+    """ get_redis_args() for tornadoredis, which selects the db and
+    authenticates once it's connected. """
+    args = get_redis_args(url_parts)
+    args['selected_db'] = args.pop('db')
+    return args
+
+
+def new_tornadoredis_client():
+    return tornadoredis.Client(**get_tornadoredis_args(REDIS_URL))
+
 # Redis client for publishing
 # REDIS = tornadoredis.Client(
 #                 host=REDIS_URL.get('host', 'localhost'),
@@ -57,100 +87,374 @@ REDIS = None
 def get_redis_client():
     global REDIS
     if REDIS is None:
-        REDIS = tornadoredis.Client(
-                        host=REDIS_URL.get('host', 'localhost'),
-                        port=REDIS_URL.get('port', 6379) or 6379)
+        REDIS = new_tornadoredis_client()
     return REDIS
 
+def reset_redis_client():
+    """ Throw away the publishing client, after losing its connection. 
+    The next get_redis_client() connects again. """
+    global REDIS
+    if REDIS is not None:
+        try:
+            REDIS.disconnect()
+        except Exception:
+            pass
+    REDIS = None
 
-class RedisSignalConnection(BaseSignalConnection):
-    # This is the redis channel of this connection.
-    __channel__ = app_settings.CLIENTSIGNAL_BACKEND_OPTIONS.get('CHANNEL_PREFIX', 'clientsignal') + "_default"
 
-    # This is called from the Django side.
-    @classmethod
-    def register_signal(cls, name, signal, listen=False, broadcast=False):
-        super(RedisSignalConnection, cls).register_signal(name, 
-                signal, listen=listen, broadcast=broadcast)
-
-        if listen:
-            ## Listen signals
-            # Create an event handler to wrap the signal from a client
-            # and add it to the EventConnection's _events.
-            if name not in cls._events:
-                def handler(conn, *args, **kwargs):
-                    log.info(str(conn) + " received signal " + name)
-                    signal.send(conn.request.user, **kwargs)
-
-                log.debug("Registering signal to listen from client %s" % name)
-                cls._events[name] = handler
-
-        if broadcast:
-            # Generate a listener function for the given signal with the
-            # given name and return it. This function will be connected to
-            # the signal and will publish it to Redis on receipt.
-            def listener_factory(name, signal):
-                def listener(sender, **kwargs):
-                    # Remove the 'signal' object from the kwargs, it's not
-                    # serializable, and we don't need it.
-                    del kwargs['signal']
-                    kwargs['sender'] = sender
-
-                    json_evt = encode_event(name, **kwargs)
-                    log.debug("BROADCAST: Encoding and Sending %s(%s) signal to Redis channel %s" % (name, json_evt, cls.__channel__))
-
-                    try:
-                        get_redis_client().publish(cls.__channel__, "%s:%s" % (name, json_evt))
-                    except Exception, e:
-                        log.error("Cannot publish to redis: %s" % e);
-
-                return listener
-
-            # Receive the signal within Django and publish it to the Redis
-            # channel for this connection.
-            log.debug("Registering signal for broadcast to client %s" % name)
-
-            listener = listener_factory(name, signal)
-
-            # We don't want a weakref to the handler function, we don't
-            # want it garbage collected.
-            signal.connect(listener, weak=False)
-
-    def on_open(self, connection_info):
-        # Fire up the redis connection
-        self.__redis_listen()
-
-        super(RedisSignalConnection, self).on_open(connection_info)
-        
-    def on_close(self):
-        super(RedisSignalConnection, self).on_close()
-
-        self.__redis.disconnect()
-
-        # Disconnect signals that this connection was listening to.
-        for name, signal in self._broadcast_signals.items():
-            listener = self._listeners[name]
-            signal.disconnect(listener, weak=False)
+# Counts of messages held in an outbox while Redis couldn't be reached,
+# dropped from a full one, and sent from one once it could.
+PUBLISH_STATS = Counter()
+
+
+class Outbox(object):
+    """
+    Messages that couldn't be published, held until Redis can be reached
+    again. Once size are held the oldest are dropped.
+    """
+
+    size = app_settings.CLIENTSIGNAL_BACKEND_OPTIONS.get(
+            'PUBLISH_OUTBOX_SIZE', 10000)
+
+    def __init__(self):
+        self.messages = deque()
+        # The sync publisher is shared by every thread.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def hold(self, messages, retry=False):
+        """ Hold (channel, message) pairs. Messages being retried go
+        ahead of the ones held since they were sent. """
+        with self.lock:
+            if retry:
+                self.messages.extendleft(reversed(messages))
+            else:
+                self.messages.extend(messages)
+            PUBLISH_STATS['queued'] += len(messages)
+
+            dropped = len(self.messages) - self.size
+            for i in range(dropped):
+                self.messages.popleft()
+            if dropped > 0:
+                PUBLISH_STATS['dropped'] += dropped
+                log.warning("Redis outbox full, dropped %s messages" % 
+                        dropped)
+
+    def take(self):
+        """ Remove and return every message held. """
+        with self.lock:
+            messages = list(self.messages)
+            self.messages.clear()
+            return messages
+
+
+class RedisPublisher(object):
+    """
+    Queues messages to publish to Redis and sends them as a single
+    pipeline once per IOLoop iteration, or as soon as batch_size are
+    waiting, rather than making a round trip for each one. Messages are
+    sent in the order they were published.
+
+    If Redis can't be reached, the messages are held in an Outbox, along
+    with any published until it can, and the publisher reconnects with
+    exponential backoff. The outbox is sent before anything newer once
+    it's back. Messages whose pipeline lost its connection part way
+    through may be sent twice.
+    """
+
+    batch_size = app_settings.CLIENTSIGNAL_BACKEND_OPTIONS.get(
+            'PUBLISH_BATCH_SIZE', 1000)
+
+    # The number of commands publish_command() pipelines for each
+    # message.
+    commands_per_message = 1
+
+    def __init__(self):
+        # (channel, message) pairs waiting to be sent.
+        self.queue = []
+        self.flush_scheduled = False
+        self.outbox = Outbox()
+        self.backoff = Backoff()
+
+    def publish(self, channel, message):
+        self.queue.append((channel, message))
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            tornado.ioloop.IOLoop.instance().add_callback(self.flush)
+
+    def publish_many(self, messages):
+        """ Publish a batch of (channel, message) pairs right away. """
+        self.queue.extend(messages)
+        self.flush()
+
+    def flush(self):
+        self.flush_scheduled = False
+        if not self.queue:
+            return
+
+        messages, self.queue = self.queue, []
+        if self.backoff.failing:
+            # Wait for the reconnect.
+            self.outbox.hold(messages)
+            return
+
+        log.debug("Publishing %s messages to Redis" % len(messages))
+        self.send(messages)
+
+    def send(self, messages, replay=False):
+        # Connection errors are raised here, or later from the
+        # pipeline's callbacks.
+        def on_error(typ, value, tb):
+            self.on_failed(messages, value, replay)
+            return True
+
+        with tornado.stack_context.ExceptionStackContext(on_error):
+            pipe = get_redis_client().pipeline()
+            for channel, message in messages:
+                self.publish_command(pipe, channel, message)
+            pipe.execute(callback=partial(self.on_published, messages, 
+                replay))
+
+    def publish_command(self, client, channel, message):
+        """ Send (or add to a pipeline) the command that publishes the 
+        message on the channel. """
+        client.publish(channel, message)
+
+    def on_published(self, messages, replay, results):
+        failed = []
+        errors = []
+        n = self.commands_per_message
+        for i, message in enumerate(messages):
+            for result in results[i * n:(i + 1) * n]:
+                if isinstance(result, tornadoredis.ConnectionError):
+                    failed.append(message)
+                    errors.append(result)
+                    break
+                elif isinstance(result, Exception):
+                    log.error("Cannot publish to redis: %s" % result);
+
+        if failed:
+            self.on_failed(failed, errors[0], replay)
+        elif replay:
+            PUBLISH_STATS['replayed'] += len(messages)
+            # Send anything held while these were being sent, before
+            # going back to publishing normally.
+            self.reconnect()
+
+    def on_failed(self, messages, error, replay=False):
+        self.outbox.hold(messages, retry=True)
+        if self.backoff.failing and not replay:
+            # The reconnect is already scheduled.
+            return
+
+        delay = self.backoff.next()
+        log.error("Cannot publish to redis, retrying in %ss: %s" % 
+                (delay, error))
+        reset_redis_client()
+        io_loop = tornado.ioloop.IOLoop.instance()
+        io_loop.add_timeout(io_loop.time() + delay, self.reconnect)
+
+    def reconnect(self):
+        messages = self.outbox.take()
+        if messages:
+            self.send(messages, replay=True)
+            return
+
+        if self.backoff.failing:
+            log.info("Reconnected to Redis")
+            self.backoff.reset()
+        self.flush()
+
+
+# A redis-py connection pool, for publishing from outside of the IOLoop.
+# redis-py pools are thread safe and replace their connections after a
+# fork.
+POOL = None
+def get_redis_pool():
+    global POOL
+    if POOL is None:
+        POOL = redis.ConnectionPool(**get_redis_args(REDIS_URL))
+    return POOL
+
+
+class SyncRedisPublisher(object):
+    """
+    Publishes to Redis from code that isn't running on an IOLoop, like
+    Django's WSGI workers or Celery, using a pooled redis-py client.
+
+    Messages that can't be sent are held in an Outbox, as they are by
+    RedisPublisher, and sent ahead of the next messages published once
+    the backoff delay has passed.
+    """
+
+    def __init__(self):
+        self.client = redis.StrictRedis(connection_pool=get_redis_pool())
+        self.outbox = Outbox()
+        self.backoff = Backoff()
+        self.retry_at = 0
+
+    def publish(self, channel, message):
+        self.publish_many([(channel, message)])
+
+    def publish_many(self, messages):
+        """ Publish a batch of (channel, message) pairs in one 
+        pipeline. """
+        if self.backoff.failing and time.time() < self.retry_at:
+            self.outbox.hold(messages)
+            return
+
+        held = self.outbox.take()
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for channel, message in held + messages:
+                self.publish_command(pipe, channel, message)
+            pipe.execute()
+        except (redis.ConnectionError, redis.TimeoutError), e:
+            self.outbox.hold(held + messages, retry=True)
+            delay = self.backoff.next()
+            self.retry_at = time.time() + delay
+            log.error("Cannot publish to redis, retrying in %ss: %s" % 
+                    (delay, e))
+        except redis.RedisError, e:
+            log.error("Cannot publish to redis: %s" % e);
+        else:
+            if held:
+                log.info("Reconnected to Redis, sent %s held messages" % 
+                        len(held))
+                PUBLISH_STATS['replayed'] += len(held)
+            self.backoff.reset()
+
+    def publish_command(self, client, channel, message):
+        client.publish(channel, message)
+
+
+PUBLISHER = None
+SYNC_PUBLISHER = None
+def get_redis_publisher():
+    """ 
+    The publisher to use in this thread: the pipelining tornadoredis 
+    publisher on the IOLoop, and the pooled redis-py publisher 
+    everywhere else.
+    """
+    global PUBLISHER, SYNC_PUBLISHER
+    if not ioloop_running():
+        if SYNC_PUBLISHER is None:
+            SYNC_PUBLISHER = SyncRedisPublisher()
+        return SYNC_PUBLISHER
+
+    if PUBLISHER is None:
+        PUBLISHER = RedisPublisher()
+    return PUBLISHER
+
+
+class RedisSubscriber(Subscriber):
+    """
+    The Redis subscription shared by all of the signal connections in
+    this process.
+    """
+
+    def __init__(self):
+        super(RedisSubscriber, self).__init__()
+        self.client = None
+        self.listening = False
+        self.backoff = Backoff()
+        self.reconnecting = False
+
+    def connect(self):
+        """ Connect to Redis if we aren't already, raising
+        ConnectionError if it can't be reached. """
+        if self.client is not None:
+            return
+
+        client = new_tornadoredis_client()
+        client.connect()
+        self.client = client
+        self.backoff.reset()
 
     @tornado.gen.engine
-    def __redis_listen(self):
-        self.__redis = tornadoredis.Client(
-                host=REDIS_URL.get('host', 'localhost'),
-                port=REDIS_URL.get('port', 6379) or 6379)
-        self.__redis.connect()
-        yield tornado.gen.Task(self.__redis.subscribe, self.__channel__)
-        self.__redis.listen(self.__on_redis_message)
-
-    def __on_redis_message(self, message):
-        # XXX: Effectively, what this does is un-json so we can re-json
-        # in a different form. Surely there's a more efficient way.
+    def subscribe(self, channel):
+        if self.reconnecting:
+            # The reconnect resubscribes to every channel.
+            return
+
+        try:
+            self.connect()
+        except tornadoredis.ConnectionError, e:
+            log.error("Cannot connect to Redis: %s" % e)
+            self.schedule_reconnect()
+            return
+
+        log.debug("Subscribing to Redis channel %s" % channel)
+        yield tornado.gen.Task(self.client.subscribe, channel)
+
+        if not self.listening:
+            self.listening = True
+            self.client.listen(self.on_message, self.on_listen_exit)
+
+    def unsubscribe(self, channel):
+        if self.client is None:
+            return
+
+        log.debug("Unsubscribing from Redis channel %s" % channel)
+        self.client.unsubscribe(channel)
+
+    def on_listen_exit(self, *args):
+        # tornadoredis stops listening when the last channel is
+        # unsubscribed; the next subscribe has to start it again.
+        self.listening = False
+
+    def on_message(self, message):
+        if message.kind == 'disconnect':
+            log.error("Lost connection to Redis")
+            self.client = None
+            self.listening = False
+            self.on_lost()
+            self.schedule_reconnect()
+            return
+
         if message.kind != 'message':
             return
 
-        name, json_evt = message.body.split(':', 1)
+        self.on_channel_message(message.channel, message.body)
 
-        if name in self._broadcast_signals:
-            log.debug("Sending JSON signal from Redis: %s %s %s" % (self, name, json_evt))
-            # This event is already json-encoded.
-            self.send_raw(json_evt)
+    def schedule_reconnect(self):
+        if self.reconnecting:
+            return
+
+        self.reconnecting = True
+        delay = self.backoff.next()
+        log.info("Resubscribing to Redis in %ss" % delay)
+        io_loop = tornado.ioloop.IOLoop.instance()
+        io_loop.add_timeout(io_loop.time() + delay, self.reconnect)
+
+    def reconnect(self):
+        # If Redis is still down, subscribe() schedules the next try.
+        self.reconnecting = False
+        self.resubscribe()
+
+
+SUBSCRIBER = None
+def get_redis_subscriber():
+    global SUBSCRIBER
+    if SUBSCRIBER is None:
+        SUBSCRIBER = RedisSubscriber()
+    return SUBSCRIBER
 
+
+class RedisSignalConnection(BackendSignalConnection):
+    """
+    A signal connection that publishes its broadcast signals through
+    Redis pub/sub, reaching the connections in every process.
+    """
+
+    @classmethod
+    def get_publisher(cls):
+        return get_redis_publisher()
+
+    @classmethod
+    def get_subscriber(cls):
+        return get_redis_subscriber()
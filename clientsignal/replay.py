@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Will Barton.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright 
+#      notice, this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright 
+#      notice, this list of conditions and the following disclaimer in the 
+#      documentation and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL
+# THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Broadcasts to a signal connection class's clients are numbered in the
+# order this process sends them, and the last few are kept so that a
+# client that reconnects can be sent only the ones it missed. Sequence
+# numbers belong to one process's stream, which is identified by a
+# random epoch; a client that reconnects to a different process (or
+# after a restart) has to resync instead.
+
+import os
+import uuid
+from collections import deque, namedtuple
+
+import logging
+log = logging.getLogger(__name__)
+
+
+ReplayEvent = namedtuple('ReplayEvent', 'seq name kwargs encoded topic')
+
+
+class ReplayBuffer(object):
+    """
+    The last size broadcasts sent to one connection class's clients in
+    this process. Each is kept with its kwargs, or its event encoded
+    with the class's codec, or both, and the topic it was sent with.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.epoch = uuid.uuid4().hex
+        self.pid = os.getpid()
+        self.seq = 0
+        self.events = deque(maxlen=size)
+        # Sequence numbers are skipped when this process stops
+        # receiving the broadcasts of a topic (or, for None, the class's
+        # own signals), or loses all of them. Clients that last saw an
+        # earlier one may have missed some.
+        self.gaps = {}
+        self.lost = 0
+
+    def add(self, name, kwargs=None, encoded=None, topic=None):
+        """ Number and keep a broadcast, returning its sequence number.
+        """
+        self.seq += 1
+        self.events.append(ReplayEvent(self.seq, name, kwargs, encoded, 
+            topic))
+        return self.seq
+
+    def mark_gap(self, topic=None):
+        """ Note that broadcasts with the given topic (or without one)
+        won't be received until it's subscribed to again. """
+        self.seq += 1
+        self.gaps[topic] = self.seq
+
+        # Gaps from before the oldest event kept can't matter any more.
+        if len(self.gaps) > self.size:
+            oldest = self.events[0].seq if self.events else self.seq
+            self.gaps = dict((t, s) for t, s in self.gaps.items()
+                    if s >= oldest)
+
+    def mark_lost(self):
+        """ Note that broadcasts may have been missed altogether, after
+        losing the connection to the backend. """
+        self.seq += 1
+        self.lost = self.seq
+
+    def missed(self, epoch, seq, topics=()):
+        """
+        Return the events after sequence number seq of the given epoch
+        that were sent to the class or the given topics, or None if they
+        aren't all here.
+        """
+        if epoch != self.epoch or seq > self.seq:
+            return None
+
+        # Nothing may have been dropped from the buffer or missed since.
+        if seq < self.lost:
+            return None
+        if self.events and seq < self.events[0].seq - 1:
+            return None
+        for topic in (None,) + tuple(topics):
+            if seq < self.gaps.get(topic, 0):
+                return None
+
+        missed = []
+        for e in reversed(self.events):
+            if e.seq <= seq:
+                break
+            if e.topic is None or e.topic in topics:
+                missed.append(e)
+        missed.reverse()
+        return missed
@@ -30,9 +30,9 @@ from django.conf import settings
 
 ## Backend settings: 
 
-# Right now a redis backend is the only kind supported. 
-
-# "redis://:password@host:port/db"
+# "redis://:password@host:port/db" for Redis pub/sub,
+# "redis+streams://:password@host:port/db" for Redis Streams, or
+# "ipc:///path/to/socket" for processes on one host.
 CLIENTSIGNAL_BACKEND_DEFAULT = ''
 CLIENTSIGNAL_BACKEND = getattr(settings, 
         'CLIENTSIGNAL_BACKEND',
@@ -40,6 +40,26 @@ CLIENTSIGNAL_BACKEND = getattr(settings,
 
 CLIENTSIGNAL_BACKEND_OPTIONS_DEFAULT = {
         'CHANNEL_PREFIX': 'clientsignal',
+        # The Redis channel each broadcast signal is published on, from
+        # the connection class's channel and the signal's name.
+        'CHANNEL_FORMAT': '%(channel)s.%(name)s',
+        # Publishes are sent to Redis as a pipeline once per IOLoop
+        # iteration, or as soon as this many are waiting.
+        'PUBLISH_BATCH_SIZE': 1000,
+        # While Redis can't be reached, up to this many publishes are
+        # held and sent once it can. Reconnects back off exponentially
+        # from RECONNECT_DELAY to MAX_RECONNECT_DELAY seconds.
+        'PUBLISH_OUTBOX_SIZE': 10000,
+        'RECONNECT_DELAY': 0.1,
+        'MAX_RECONNECT_DELAY': 5,
+        # With redis+streams://, streams are trimmed to about this many
+        # entries, and each XREAD waits this many milliseconds for new
+        # ones. Streams (one for each topic and user, as well as each
+        # signal) are deleted once nothing has been added to them for
+        # STREAM_TTL seconds; None keeps them.
+        'STREAM_MAXLEN': 10000,
+        'STREAM_BLOCK': 100,
+        'STREAM_TTL': 86400,
 }
 CLIENTSIGNAL_BACKEND_OPTIONS = getattr(settings, 
         'CLIENTSIGNAL_BACKEND_OPTIONS',
@@ -58,6 +78,17 @@ CLIENTSIGNAL_CONNECTIONS = getattr(settings,
         'CLIENTSIGNAL_CONNECTIONS',
         CLIENTSIGNAL_CONNECTIONS_DEFAULT)
 
+## Encoding Settings
+
+# The default codec for signal connections, either a registered codec
+# name ('json' or 'fastjson') or the import path of a Codec class or
+# instance. This can be set per connection class with the codec
+# attribute.
+CLIENTSIGNAL_CODEC_DEFAULT = 'json'
+CLIENTSIGNAL_CODEC = getattr(settings, 
+        'CLIENTSIGNAL_CODEC',
+        CLIENTSIGNAL_CODEC_DEFAULT)
+
 ## Custom JSON Encoding Settings
 CLIENTSIGNAL_JSON_ENCODER_DEFAULT = 'clientsignal.SignalEncoder'
 CLIENTSIGNAL_JSON_ENCODER = getattr(settings, 
@@ -75,6 +106,98 @@ CLIENTSIGNAL_SOCKJS_URL = getattr(settings,
 
 CLIENTSIGNAL_DISABLED_TRANSPORTS = [],
 
+## Request settings
+
+# The middleware (which must also be in MIDDLEWARE_CLASSES) whose
+# process_request() is run over the Django request built for each
+# connection. This can be set per connection class with the
+# request_middleware attribute.
+CLIENTSIGNAL_REQUEST_MIDDLEWARE_DEFAULT = ()
+CLIENTSIGNAL_REQUEST_MIDDLEWARE = getattr(settings, 
+        'CLIENTSIGNAL_REQUEST_MIDDLEWARE',
+        CLIENTSIGNAL_REQUEST_MIDDLEWARE_DEFAULT)
+
+## Outbound message settings
+
+# Messages to each client are queued and written together in one frame
+# after this many milliseconds (0 is the next IOLoop iteration), or
+# sooner if CLIENTSIGNAL_FLUSH_SIZE bytes are queued. None writes each
+# message as it is sent. These can be set per connection class with the
+# flush_delay and flush_size attributes.
+CLIENTSIGNAL_FLUSH_DELAY_DEFAULT = 0
+CLIENTSIGNAL_FLUSH_DELAY = getattr(settings, 
+        'CLIENTSIGNAL_FLUSH_DELAY',
+        CLIENTSIGNAL_FLUSH_DELAY_DEFAULT)
+CLIENTSIGNAL_FLUSH_SIZE_DEFAULT = 65536
+CLIENTSIGNAL_FLUSH_SIZE = getattr(settings, 
+        'CLIENTSIGNAL_FLUSH_SIZE',
+        CLIENTSIGNAL_FLUSH_SIZE_DEFAULT)
+
+# The most messages that may be queued for a client that isn't keeping
+# up, and what to do with more: 'drop-oldest', 'drop-newest',
+# 'coalesce' or 'disconnect'. None allows any number of messages. These
+# can be set per connection class with the max_queue and
+# overflow_policy attributes, and per broadcast signal.
+CLIENTSIGNAL_MAX_QUEUE_DEFAULT = 1000
+CLIENTSIGNAL_MAX_QUEUE = getattr(settings, 
+        'CLIENTSIGNAL_MAX_QUEUE',
+        CLIENTSIGNAL_MAX_QUEUE_DEFAULT)
+CLIENTSIGNAL_OVERFLOW_POLICY_DEFAULT = 'drop-oldest'
+CLIENTSIGNAL_OVERFLOW_POLICY = getattr(settings, 
+        'CLIENTSIGNAL_OVERFLOW_POLICY',
+        CLIENTSIGNAL_OVERFLOW_POLICY_DEFAULT)
+
+## Fan-out settings
+
+# Broadcasts are sent to this many clients at a time. Once a broadcast
+# has taken CLIENTSIGNAL_FANOUT_BUDGET milliseconds, the rest of it
+# waits for the next IOLoop iteration.
+CLIENTSIGNAL_FANOUT_CHUNK_SIZE_DEFAULT = 1000
+CLIENTSIGNAL_FANOUT_CHUNK_SIZE = getattr(settings, 
+        'CLIENTSIGNAL_FANOUT_CHUNK_SIZE',
+        CLIENTSIGNAL_FANOUT_CHUNK_SIZE_DEFAULT)
+
+CLIENTSIGNAL_FANOUT_BUDGET_DEFAULT = 10
+CLIENTSIGNAL_FANOUT_BUDGET = getattr(settings, 
+        'CLIENTSIGNAL_FANOUT_BUDGET',
+        CLIENTSIGNAL_FANOUT_BUDGET_DEFAULT)
+
+## Replay settings
+
+# Broadcasts to each signal connection class are numbered, and the last
+# CLIENTSIGNAL_REPLAY_SIZE of them kept in each process, so that clients
+# that reconnect can be sent the ones they missed. 0 turns this off.
+# This can be set per connection class with the replay_size attribute.
+CLIENTSIGNAL_REPLAY_SIZE_DEFAULT = 1000
+CLIENTSIGNAL_REPLAY_SIZE = getattr(settings, 
+        'CLIENTSIGNAL_REPLAY_SIZE',
+        CLIENTSIGNAL_REPLAY_SIZE_DEFAULT)
+
+## Session and authentication settings
+
+# Sessions and users are loaded for new connections in a thread pool so
+# that the database queries don't block the IOLoop. This is the number
+# of threads in that pool.
+CLIENTSIGNAL_SESSION_THREADS_DEFAULT = 4
+CLIENTSIGNAL_SESSION_THREADS = getattr(settings, 
+        'CLIENTSIGNAL_SESSION_THREADS',
+        CLIENTSIGNAL_SESSION_THREADS_DEFAULT)
+
+# Loaded sessions and users are cached by session key, for up to
+# CLIENTSIGNAL_SESSION_CACHE_TTL seconds. Logins and logouts in this
+# process invalidate the cache immediately, logins and logouts in other
+# processes (the web processes, usually) will be seen when the cached
+# entry expires: until then a user who has logged out can still open
+# connections as themselves. The TTL is that window.
+CLIENTSIGNAL_SESSION_CACHE_SIZE_DEFAULT = 10000
+CLIENTSIGNAL_SESSION_CACHE_SIZE = getattr(settings, 
+        'CLIENTSIGNAL_SESSION_CACHE_SIZE',
+        CLIENTSIGNAL_SESSION_CACHE_SIZE_DEFAULT)
+CLIENTSIGNAL_SESSION_CACHE_TTL_DEFAULT = 60
+CLIENTSIGNAL_SESSION_CACHE_TTL = getattr(settings, 
+        'CLIENTSIGNAL_SESSION_CACHE_TTL',
+        CLIENTSIGNAL_SESSION_CACHE_TTL_DEFAULT)
+
 ## Stats Settings
 
 CLIENTSIGNAL_STATS = getattr(settings, 
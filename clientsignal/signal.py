@@ -43,6 +43,11 @@ def signal_object_hook(parsed_dict):
 
 class SignalEncoder(json.JSONEncoder):
     def default(self, obj):
+        # Imported here, clientsignal.conn imports this module.
+        from django import http
+        from django.contrib.auth.models import User, AnonymousUser
+        from clientsignal.conn import BaseSignalConnection
+
         if isinstance(obj, BaseSignalConnection):
             d = {'user': obj.request.user.username}
             return d
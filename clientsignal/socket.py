@@ -28,42 +28,186 @@
 
 import clientsignal.settings as app_settings
 
+import time
+from collections import defaultdict, deque, namedtuple, Counter
+
+import tornado.ioloop
 import sockjs.tornado
-import simplejson as json 
-# import json
 
 from inspect import ismethod, getmembers
 
-from clientsignal.utils import get_class_or_func
+from clientsignal.codec import get_codec
 
 import logging
 log = logging.getLogger(__name__)
 
-# First we need to override the json_endcode and json_decode functions
-# that sockjs-tornado uses to 
 
+# Encode and decode objects with the default codec (CLIENTSIGNAL_CODEC).
+# Connections use their own class's codec.
 def json_encode(data):
-    """ Encode the object with the configuable object hook. """
-    encoder_cls = get_class_or_func(app_settings.CLIENTSIGNAL_JSON_ENCODER)
-    return json.dumps(data, separators=(',', ':'), cls=encoder_cls)
+    return get_codec(app_settings.CLIENTSIGNAL_CODEC).encode(data)
 
 def json_decode(data):
-    """ Decode the object with the configuable object hook. """
-    object_hook = get_class_or_func(app_settings.CLIENTSIGNAL_JSON_OBJECT_HOOK)
-    return json.loads(data, object_hook=object_hook)
-
-
-# XXX: Monkeypatch these in. I dislike doing this, but there's no other
-# means to provide custom json encoding/decoding.
-sockjs.tornado.proto.json_encode = json_encode
-sockjs.tornado.proto.json_decode = json_decode
+    return get_codec(app_settings.CLIENTSIGNAL_CODEC).decode(data)
 
 
 # Create an "event", which is basically a message that encapsulates a
 # name and some keyword arguments. Presently, only kwargs are used.
 def encode_event(name, **kwargs):
-    e = {'event':name, 'data':kwargs}
-    return json_encode(e);
+    return get_codec(app_settings.CLIENTSIGNAL_CODEC).encode_event(name,
+            kwargs)
+
+
+class FanOut(object):
+    """
+    Sending an already-encoded event to many clients. Like
+    SockJSRouter.broadcast this JSON-frames the event once for all of
+    the clients. Connections that coalesce their messages queue the
+    framed event, otherwise the SockJS array frame is built once and the
+    same bytes are written to every session that can be written to right
+    away.
+    """
+
+    def __init__(self, clients, raw_data, name=None, kwargs=None):
+        self.clients = clients
+        self.raw_data = raw_data
+        self.name = name
+        self.kwargs = kwargs
+        self.sent = 0
+        self.started = time.time()
+        self.jsonified = None
+        self.frame = None
+
+    def send(self, count):
+        """ Send to the next count clients. Returns True once every 
+        client has been sent to. """
+        raw_data, name, kwargs = self.raw_data, self.name, self.kwargs
+        router = None
+        sent = 0
+
+        for conn in self.clients[self.sent:self.sent + count]:
+            session = conn.session
+            if session.is_closed:
+                continue
+
+            if session.send_expects_json:
+                if self.jsonified is None:
+                    self.jsonified = sockjs.tornado.proto.json_encode(raw_data)
+                    self.frame = 'a[%s]' % self.jsonified
+
+                handler = session.handler
+                if conn.flush_delay is not None:
+                    conn.queue_message(self.jsonified, name, kwargs)
+                elif (session._immediate_flush and handler is not None and
+                        handler.active and not session.send_queue):
+                    handler.send_pack(self.frame)
+                else:
+                    session.send_jsonified(self.jsonified, False)
+            elif conn.flush_delay is not None:
+                conn.queue_message(raw_data, name, kwargs)
+            else:
+                session.send_message(raw_data, stats=False)
+
+            router = session.server
+            sent += 1
+
+        if router is not None:
+            router.stats.on_pack_sent(sent)
+
+        self.sent += count
+        return self.sent >= len(self.clients)
+
+
+class FanOutQueue(object):
+    """
+    Sends broadcasts to their clients in order, chunk_size clients at a
+    time. Once a broadcast has taken budget seconds, the rest of it (and
+    any broadcasts after it) waits for the next IOLoop iteration, so
+    that a broadcast to a great many clients doesn't stall everything
+    else on the IOLoop. Small broadcasts with nothing ahead of them are
+    sent straight away.
+    """
+
+    chunk_size = app_settings.CLIENTSIGNAL_FANOUT_CHUNK_SIZE
+    budget = app_settings.CLIENTSIGNAL_FANOUT_BUDGET / 1000.0
+
+    def __init__(self):
+        self.fanouts = deque()
+        self.scheduled = False
+        self.reset_stats()
+
+    def add(self, fanout):
+        if not self.fanouts and len(fanout.clients) <= self.chunk_size:
+            fanout.send(self.chunk_size)
+            self.finished(fanout)
+            return
+
+        self.fanouts.append(fanout)
+        if not self.scheduled:
+            self.run()
+
+    def run(self):
+        self.scheduled = False
+        deadline = time.time() + self.budget
+        while self.fanouts:
+            fanout = self.fanouts[0]
+            if fanout.send(self.chunk_size):
+                self.fanouts.popleft()
+                self.finished(fanout)
+            if time.time() >= deadline:
+                break
+
+        if self.fanouts:
+            self.scheduled = True
+            tornado.ioloop.IOLoop.instance().add_callback(self.run)
+
+    def finished(self, fanout):
+        duration = time.time() - fanout.started
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+    def reset_stats(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def sample_stats(self):
+        """ Return the number of broadcasts finished since the last
+        sample, and their mean and longest durations in ms. """
+        stats = (self.count, 
+                self.total_time / self.count * 1e3 if self.count else 0.0,
+                self.max_time * 1e3)
+        self.reset_stats()
+        return stats
+
+
+FANOUT_QUEUE = None
+def get_fanout_queue():
+    global FANOUT_QUEUE
+    if FANOUT_QUEUE is None:
+        FANOUT_QUEUE = FanOutQueue()
+    return FANOUT_QUEUE
+
+
+# Send an already-encoded event to many clients, through the fan-out
+# queue.
+def broadcast_raw(clients, raw_data, name=None, kwargs=None):
+    clients = list(clients)
+    if clients:
+        get_fanout_queue().add(FanOut(clients, raw_data, name, kwargs))
+    return len(clients)
+
+
+# Encode an event once (per codec) and send it to many clients.
+def broadcast_event(clients, name, **kwargs):
+    by_codec = defaultdict(list)
+    for conn in clients:
+        by_codec[conn._codec].append(conn)
+
+    return sum(broadcast_raw(codec_clients, codec.encode_event(name, kwargs),
+                name, kwargs)
+            for codec, codec_clients in by_codec.items())
 
 
 # An exception specially for events
@@ -71,17 +215,63 @@ class EventException(Exception):
     pass
 
 
+# What to do when a connection's outbound queue is full: drop the oldest
+# queued message, drop the new message, replace a queued message with
+# the same coalescing key (dropping the oldest if there isn't one), or
+# close the connection.
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+
+# A limit on the queued messages of one event. coalesce_key is the name
+# of a keyword argument or a function of the kwargs that returns a key;
+# a queued message with the same key is replaced by a newer one.
+QueueLimit = namedtuple('QueueLimit', 'max_queue policy coalesce_key')
+
+
+# Events used by clientsignal.js and the server to talk to each other,
+# rather than to the application.
+HELLO_EVENT = 'clientsignal.hello'
+SUBSCRIBE_EVENT = 'clientsignal.subscribe'
+UNSUBSCRIBE_EVENT = 'clientsignal.unsubscribe'
+STREAM_EVENT = 'clientsignal.stream'
+RESUME_EVENT = 'clientsignal.resume'
+RESYNC_EVENT = 'clientsignal.resync'
+RESUMED_EVENT = 'clientsignal.resumed'
+RECONNECT_EVENT = 'clientsignal.reconnect'
+
+
+# Make a method the handler for the event with the given name, for event
+# names that can't be written as "event_" method names.
+def event(name):
+    def decorator(method):
+        method.event_name = name
+        return method
+    return decorator
+
+
 # Populate a private list of events for the class based on any methods
-# that begin with "event_".
+# that begin with "event_" or are decorated with event().
 class EventHandlerMeta(type):
     def __init__(cls, name, bases, attrs):
         # Find all events, including bases.
-        is_event = lambda m: ismethod(m) and m.__name__.startswith('event_')
-        events = [(n[6:], e) for n,e in getmembers(cls, is_event)]
+        is_event = lambda m: ismethod(m) and (
+                m.__name__.startswith('event_') or hasattr(m, 'event_name'))
+        events = [(getattr(e, 'event_name', n[6:]), e) 
+                for n,e in getmembers(cls, is_event)]
 
         # Set the _events dictionary for lookup.
         setattr(cls, '_events', dict(events))
 
+        # Resolve the class's codec.
+        setattr(cls, '_codec', get_codec(cls.codec))
+
+        # Per-event outbound queue limits, and counts of the messages
+        # dropped, coalesced or disconnected by them.
+        setattr(cls, '_queue_limits', dict())
+        setattr(cls, '_queue_stats', Counter())
+
         super(EventHandlerMeta, cls).__init__(name, bases, attrs)
 
 
@@ -92,27 +282,122 @@ class EventHandlerMeta(type):
 class EventConnection(sockjs.tornado.SockJSConnection):
     __metaclass__ = EventHandlerMeta
 
+    # The name or import path of the codec used to encode and decode
+    # this class's events.
+    codec = app_settings.CLIENTSIGNAL_CODEC
+
+    # The name or import path of a binary codec (such as 'msgpack') that
+    # clients may ask to switch to when they connect, or None.
+    binary_codec = None
+
+    # Messages sent to a client are queued and written together, in one
+    # SockJS frame, after flush_delay milliseconds (0 being the next
+    # IOLoop iteration) or once flush_size bytes are queued. A
+    # flush_delay of None writes every message as it's sent.
+    flush_delay = app_settings.CLIENTSIGNAL_FLUSH_DELAY
+    flush_size = app_settings.CLIENTSIGNAL_FLUSH_SIZE
+
+    # Messages are held in the queue while the client isn't keeping up.
+    # Once max_queue messages are queued, overflow_policy decides what
+    # to do with more. Limits for particular events can be set with
+    # set_queue_limit(). Only queued (flush_delay not None) connections
+    # are limited.
+    max_queue = app_settings.CLIENTSIGNAL_MAX_QUEUE
+    overflow_policy = app_settings.CLIENTSIGNAL_OVERFLOW_POLICY
+
+    # Milliseconds to wait before trying again to flush to a client
+    # that isn't keeping up.
+    flush_retry = 100
+
+    def __init__(self, session):
+        super(EventConnection, self).__init__(session)
+        self._outbox = deque()
+        self._outbox_size = 0
+        self._outbox_len = 0
+        self._outbox_counts = Counter()
+        self._outbox_keys = {}
+        self._flush_scheduled = False
+        self._flush_timeout = None
+
+    @classmethod
+    def set_queue_limit(cls, name, max_queue=None, policy=None,
+            coalesce_key=None):
+        """ 
+        Limit the number of messages of the event with the given name
+        that may be queued for a client, with its own overflow policy
+        and coalescing key.
+        """
+        if policy == COALESCE and coalesce_key is None:
+            # Without a key the latest message replaces the last.
+            coalesce_key = lambda kwargs: None
+        cls._queue_limits[name] = QueueLimit(max_queue, policy, coalesce_key)
+
+    @classmethod
+    def get_queue_limit(cls, name):
+        return cls._queue_limits.get(name)
+
+    @classmethod
+    def get_event_names(cls):
+        """ The names of the events sent and received by this class. """
+        return cls._events.keys()
+
+    @classmethod
+    def get_binary_codec(cls):
+        """ Return the binary codec for this class, with its event name
+        table. This is built once, when it's first needed. """
+        if '_binary_codec' not in cls.__dict__:
+            codec = get_codec(cls.binary_codec)
+            cls._binary_codec = codec.with_events(cls.get_event_names())
+        return cls._binary_codec
+
+    @event(HELLO_EVENT)
+    def on_hello(self, codecs=(), **kwargs):
+        """ 
+        Sent by clients when they connect, with the binary codecs they
+        support. If this class has one of them, tell the client and
+        switch to it. The reply is sent in the current codec.
+        """
+        if self.binary_codec is not None and self.binary_codec in codecs:
+            codec = self.get_binary_codec()
+            self.send(HELLO_EVENT, codec=self.binary_codec,
+                    events=codec.event_ids)
+            self._codec = codec
+        else:
+            self.send(HELLO_EVENT, codec=None)
+
     def on_message(self, message):
+        codec = self._codec
+        if codec.binary and message[:1] in ('{', '['):
+            # Clients send JSON until they've received the hello reply.
+            codec = self.__class__._codec
+
         try:
-            json_message = json_decode(message)
-        except json.scanner.JSONDecodeError:
+            json_message = codec.decode(message)
+        except ValueError:
             # Not a json message.
-            log.error('Invalid event name: %s' % name)
+            log.error('Invalid message: %s' % message)
             # raise EventException("message did not contain event")
         else:
+            # Clients may batch several events into one message.
+            if isinstance(json_message, list):
+                json_messages = json_message
+            else:
+                json_messages = [json_message]
+
             # It was a json message. Check to see if it was an event.
-            if isinstance(json_message, dict):
-                try:
-                    e_name = json_message['event']
-                    e_kwargs = json_message['data']
-                except KeyError:
-                    # No event in message, or no event of that name
-                    raise EventException("message did not contain event")
+            for json_message in json_messages:
+                if isinstance(json_message, dict):
+                    try:
+                        e_name = json_message['event']
+                        e_kwargs = json_message['data']
+                    except KeyError:
+                        # No event in message, or no event of that name
+                        raise EventException("message did not contain event")
+                    else:
+                        self.on_event(e_name, e_kwargs)
                 else:
-                    self.on_event(e_name, e_kwargs)
-            else:
-                log.error('Invalid event name: %s' % name)
-                # raise EventException("message did not contain event")
+                    log.error('Invalid message: %s' % message)
+                    # raise EventException("message did not contain event")
 
     def on_event(self, name, kwargs=dict()):
         handler = self._events.get(name)
@@ -130,11 +415,177 @@ class EventConnection(sockjs.tornado.SockJSConnection):
 
     def send(self, name, **kwargs):
         log.info("sending signal %s(%s)" % (name, unicode(kwargs)));
-        event = encode_event(name, **kwargs)
-        super(EventConnection, self).send(event)
+        event = self._codec.encode_event(name, kwargs)
+        self.send_raw(event, name, kwargs)
+
+    def send_raw(self, raw_data, name=None, kwargs=None):
+        if self.is_closed:
+            return
+
+        if self.flush_delay is None:
+            super(EventConnection, self).send(raw_data)
+            return
+
+        session = self.session
+        if session.send_expects_json:
+            self.queue_message(sockjs.tornado.proto.json_encode(raw_data),
+                    name, kwargs)
+        else:
+            self.queue_message(raw_data, name, kwargs)
+        session.stats.on_pack_sent(1)
+
+    def queue_message(self, message, name=None, kwargs=None):
+        """ 
+        Queue a message to be written on the next flush. The message
+        must already be JSON-framed if the session expects it. The name
+        and kwargs of the event it encodes are used to apply queue
+        limits.
+        """
+        limit = self._queue_limits.get(name)
+        policy = self.overflow_policy
+
+        key = None
+        if limit is not None:
+            policy = limit.policy or policy
+            if limit.coalesce_key is not None:
+                key = self.get_coalesce_key(name, limit, kwargs)
+                queued = self._outbox_keys.get(key)
+                if queued is not None:
+                    self._remove_queued(queued)
+                    self._queue_stats['coalesced'] += 1
+
+        if limit is not None and limit.max_queue is not None and \
+                self._outbox_counts[name] >= limit.max_queue:
+            if not self._overflow(policy, name):
+                return
+        elif self.max_queue is not None and \
+                self._outbox_len >= self.max_queue:
+            if not self._overflow(policy, None):
+                return
+
+        entry = [message, name, key]
+        self._outbox.append(entry)
+        self._outbox_size += len(message)
+        self._outbox_len += 1
+        self._outbox_counts[name] += 1
+        if key is not None:
+            self._outbox_keys[key] = entry
+
+        if self._outbox_size >= self.flush_size:
+            self.flush()
+        elif not self._flush_scheduled:
+            self.schedule_flush(self.flush_delay)
+
+    @classmethod
+    def get_coalesce_key(cls, name, limit, kwargs):
+        coalesce_key = limit.coalesce_key
+        if callable(coalesce_key):
+            return (name, coalesce_key(kwargs or {}))
+        return (name, (kwargs or {}).get(coalesce_key))
+
+    def _remove_queued(self, entry):
+        # Entries are removed in place and skipped when flushed. Once
+        # they outnumber the rest, the outbox is compacted, so that a
+        # client that isn't flushing can't grow it without bound.
+        self._outbox_size -= len(entry[0])
+        self._outbox_len -= 1
+        self._outbox_counts[entry[1]] -= 1
+        if entry[2] is not None and self._outbox_keys.get(entry[2]) is entry:
+            del self._outbox_keys[entry[2]]
+        entry[0] = None
+
+        if len(self._outbox) > 2 * self._outbox_len:
+            self._outbox = deque(e for e in self._outbox if e[0] is not None)
+
+    def _overflow(self, policy, name):
+        """ Make room in a full queue according to the policy. Returns
+        whether the new message should be queued. """
+        if policy == DISCONNECT:
+            log.warning("Closing %s, its queue is full" % self)
+            self._queue_stats['disconnected'] += 1
+            self.close()
+            return False
+
+        self._queue_stats['dropped'] += 1
+        if policy == DROP_NEWEST:
+            return False
+
+        # Drop the oldest message (of this event, if it has its own
+        # limit).
+        for entry in self._outbox:
+            if entry[0] is not None and (name is None or entry[1] == name):
+                self._remove_queued(entry)
+                break
+        while self._outbox and self._outbox[0][0] is None:
+            self._outbox.popleft()
+        return True
+
+    def schedule_flush(self, delay):
+        self._flush_scheduled = True
+        io_loop = self.session.server.io_loop
+        if delay:
+            self._flush_timeout = io_loop.add_timeout(
+                    io_loop.time() + delay / 1000.0, self.flush)
+        else:
+            io_loop.add_callback(self.flush)
+
+    def is_backed_up(self):
+        """ 
+        Whether the client hasn't taken the last messages written to it
+        yet: they're waiting for a polling client to collect them, or
+        are still in the socket's write buffer.
+        """
+        session = self.session
+        if getattr(session, 'send_queue', None):
+            return True
+
+        handler = session.handler
+        if handler is None:
+            return False
+        stream = getattr(handler, 'stream', None) or getattr(
+                getattr(handler.request, 'connection', None), 'stream', None)
+        return stream is not None and stream.writing()
+
+    def flush(self):
+        """ Write all of the queued messages to the session, unless the
+        client is backed up. """
+        if self._flush_timeout is not None:
+            self.session.server.io_loop.remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+        self._flush_scheduled = False
+
+        if not self._outbox_len or self.is_closed:
+            return
+
+        if self.is_backed_up():
+            # Leave the messages here, where the queue limits apply.
+            self.schedule_flush(self.flush_retry)
+            return
+
+        outbox = [e[0] for e in self._outbox if e[0] is not None]
+        self._outbox = deque()
+        self._outbox_size = 0
+        self._outbox_len = 0
+        self._outbox_counts.clear()
+        self._outbox_keys.clear()
+
+        session = self.session
+        if session.send_expects_json:
+            # SockJS array frames hold any number of messages.
+            session.send_jsonified(','.join(outbox), False)
+        else:
+            for message in outbox:
+                session.send_message(message, stats=False)
 
-    def send_raw(self, raw_data):
-        super(EventConnection, self).send(raw_data)
+    def on_close(self):
+        if self._flush_timeout is not None:
+            self.session.server.io_loop.remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+        self._outbox = deque()
+        self._outbox_size = 0
+        self._outbox_len = 0
+        self._outbox_counts.clear()
+        self._outbox_keys.clear()
 
     # XXX: support socket.io nomenclature?
     def emit(self, name, **kwargs):
@@ -57,7 +57,11 @@ var ReconnectingSocket = function(url, protocols) {
 
     // Reconnecting Socket API
     this.reconnect = true;
+    // Reconnects wait a random time (full jitter) of up to
+    // reconnectInterval ms, doubling with each failed attempt up to
+    // maxReconnectInterval ms.
     this.reconnectInterval = 1000;
+    this.maxReconnectInterval = 30000;
     this.reconnectTimeout = 2000;
     this.debug = false;
 
@@ -106,14 +110,36 @@ var ReconnectingSocket = function(url, protocols) {
             conn.close();
         }
     };
+
+    // Close the connection and connect again straight away, to newUrl
+    // if one is given.
+    this.reconnectNow = function(newUrl) {
+        if (newUrl) {
+            url = newUrl;
+            this.url = newUrl;
+        }
+        if (conn) {
+            nextDelay = 0;
+            conn.close();
+        }
+    };
     
     // Private
     var conn = undefined;
     var timedOut = false;
     var forcedClose = false;
+    var attempts = 0;
+    var nextDelay = null;
     
     var self = this;
 
+    function backoff() {
+        var ceiling = Math.min(self.maxReconnectInterval,
+                self.reconnectInterval * Math.pow(2, attempts));
+        attempts++;
+        return Math.floor(Math.random() * ceiling);
+    }
+
     function connect(reconnectAttempt) {
         conn = new SockJS(url, protocols);
         
@@ -137,6 +163,7 @@ var ReconnectingSocket = function(url, protocols) {
             self.readyState = SockJS.OPEN;
             self.protocol = conn.protocol;
             reconnectAttempt = false;
+            attempts = 0;
             self.onopen(event);
         };
         
@@ -156,9 +183,12 @@ var ReconnectingSocket = function(url, protocols) {
                     self.debug && window.console && console.log('onclose', url);
                     self.onclose(event);
                 }
+                var delay = nextDelay !== null ? nextDelay : backoff();
+                nextDelay = null;
+                self.debug && window.console && console.log('reconnect-in', url, delay);
                 setTimeout(function() {
                     connect(true);
-                }, self.reconnectInterval);
+                }, delay);
             }
         };
 
@@ -178,6 +208,216 @@ var ReconnectingSocket = function(url, protocols) {
 };
 
 
+// A minimal MessagePack encoder and decoder, for the binary wire format.
+// It works on "binary strings" (one character per byte) so that messages
+// can be base64 encoded with btoa() and decoded with atob().
+var MessagePack = (function() {
+    var chr = String.fromCharCode;
+
+    function writeUint(out, n, size) {
+        for (var i = size - 1; i >= 0; i--) {
+            out.push(chr(Math.floor(n / Math.pow(2, i * 8)) & 0xff));
+        }
+    }
+
+    function writeHeader(out, length, fix, type16, type32) {
+        if (length < 16 && fix !== null) {
+            out.push(chr(fix | length));
+        } else if (length < 0x10000) {
+            out.push(chr(type16));
+            writeUint(out, length, 2);
+        } else {
+            out.push(chr(type32));
+            writeUint(out, length, 4);
+        }
+    }
+
+    function write(out, value) {
+        var type = typeof value;
+        var i, key, keys, utf8, view;
+
+        if (value === null || value === undefined || type === 'function') {
+            out.push(chr(0xc0));
+        } else if (value === false) {
+            out.push(chr(0xc2));
+        } else if (value === true) {
+            out.push(chr(0xc3));
+        } else if (type === 'number') {
+            if (Math.floor(value) === value && 
+                    value >= -2147483648 && value <= 4294967295) {
+                if (value >= 0 && value < 0x80) {
+                    out.push(chr(value));
+                } else if (value >= 0 && value < 0x100) {
+                    out.push(chr(0xcc));
+                    writeUint(out, value, 1);
+                } else if (value >= 0 && value < 0x10000) {
+                    out.push(chr(0xcd));
+                    writeUint(out, value, 2);
+                } else if (value >= 0) {
+                    out.push(chr(0xce));
+                    writeUint(out, value, 4);
+                } else if (value >= -32) {
+                    out.push(chr(value + 0x100));
+                } else if (value >= -128) {
+                    out.push(chr(0xd0));
+                    writeUint(out, value + 0x100, 1);
+                } else if (value >= -32768) {
+                    out.push(chr(0xd1));
+                    writeUint(out, value + 0x10000, 2);
+                } else {
+                    out.push(chr(0xd2));
+                    writeUint(out, value + 0x100000000, 4);
+                }
+            } else {
+                view = new DataView(new ArrayBuffer(8));
+                view.setFloat64(0, value);
+                out.push(chr(0xcb));
+                for (i = 0; i < 8; i++) {
+                    out.push(chr(view.getUint8(i)));
+                }
+            }
+        } else if (type === 'string') {
+            utf8 = unescape(encodeURIComponent(value));
+            if (utf8.length < 32) {
+                out.push(chr(0xa0 | utf8.length));
+            } else if (utf8.length < 0x100) {
+                out.push(chr(0xd9));
+                writeUint(out, utf8.length, 1);
+            } else {
+                writeHeader(out, utf8.length, null, 0xda, 0xdb);
+            }
+            out.push(utf8);
+        } else if (typeof value.toJSON === 'function') {
+            // Dates, for example, are sent as they would be in JSON.
+            write(out, value.toJSON());
+        } else if (value instanceof Array) {
+            writeHeader(out, value.length, 0x90, 0xdc, 0xdd);
+            for (i = 0; i < value.length; i++) {
+                write(out, value[i]);
+            }
+        } else {
+            keys = [];
+            for (key in value) {
+                if (value.hasOwnProperty(key)) {
+                    keys.push(key);
+                }
+            }
+            writeHeader(out, keys.length, 0x80, 0xde, 0xdf);
+            for (i = 0; i < keys.length; i++) {
+                write(out, keys[i]);
+                write(out, value[keys[i]]);
+            }
+        }
+    }
+
+    function encode(value) {
+        var out = [];
+        write(out, value);
+        return out.join('');
+    }
+
+    function decode(data) {
+        var pos = 0;
+
+        function readUint(size) {
+            var n = 0;
+            for (var i = 0; i < size; i++) {
+                n = n * 256 + data.charCodeAt(pos++);
+            }
+            return n;
+        }
+
+        function readInt(size) {
+            if (size === 8) {
+                // Read the high word signed, so that the arithmetic
+                // stays within a double's exact range.
+                var high = readInt(4);
+                return high * 0x100000000 + readUint(4);
+            }
+            var n = readUint(size);
+            var max = Math.pow(2, size * 8);
+            return n >= max / 2 ? n - max : n;
+        }
+
+        function readFloat(size) {
+            var view = new DataView(new ArrayBuffer(size));
+            for (var i = 0; i < size; i++) {
+                view.setUint8(i, data.charCodeAt(pos++));
+            }
+            return size === 4 ? view.getFloat32(0) : view.getFloat64(0);
+        }
+
+        function readRaw(length) {
+            var raw = data.substr(pos, length);
+            pos += length;
+            return raw;
+        }
+
+        function readString(length) {
+            return decodeURIComponent(escape(readRaw(length)));
+        }
+
+        function readArray(length) {
+            var array = [];
+            for (var i = 0; i < length; i++) {
+                array.push(read());
+            }
+            return array;
+        }
+
+        function readMap(length) {
+            var map = {};
+            for (var i = 0; i < length; i++) {
+                var key = read();
+                map[key] = read();
+            }
+            return map;
+        }
+
+        function read() {
+            var type = data.charCodeAt(pos++);
+
+            if (type < 0x80) return type;
+            if (type < 0x90) return readMap(type & 0x0f);
+            if (type < 0xa0) return readArray(type & 0x0f);
+            if (type < 0xc0) return readString(type & 0x1f);
+            if (type >= 0xe0) return type - 0x100;
+
+            switch (type) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return readRaw(readUint(1));
+                case 0xc5: return readRaw(readUint(2));
+                case 0xc6: return readRaw(readUint(4));
+                case 0xca: return readFloat(4);
+                case 0xcb: return readFloat(8);
+                case 0xcc: return readUint(1);
+                case 0xcd: return readUint(2);
+                case 0xce: return readUint(4);
+                case 0xcf: return readUint(8);
+                case 0xd0: return readInt(1);
+                case 0xd1: return readInt(2);
+                case 0xd2: return readInt(4);
+                case 0xd3: return readInt(8);
+                case 0xd9: return readString(readUint(1));
+                case 0xda: return readString(readUint(2));
+                case 0xdb: return readString(readUint(4));
+                case 0xdc: return readArray(readUint(2));
+                case 0xdd: return readArray(readUint(4));
+                case 0xde: return readMap(readUint(2));
+                case 0xdf: return readMap(readUint(4));
+            }
+            throw 'Invalid MessagePack type 0x' + type.toString(16);
+        }
+
+        return read();
+    }
+
+    return {encode: encode, decode: decode};
+})();
+
+
 // Based on https://gist.github.com/ismasan/299789
 // Use SignalSocket for Django signal handling via django-clientsignal.
 //
@@ -191,10 +431,73 @@ var ReconnectingSocket = function(url, protocols) {
 //          // Handle signal 
 //      });
 // 
-var SignalSocket = function(url, protocols) {
+// Options:
+//
+//      binary: Ask the server to switch to its binary (MessagePack)
+//              wire format when connected. Servers whose signal
+//              connection doesn't have a binary_codec keep using JSON.
+//
+//      batch:  Batch sent events into a single message. true sends
+//              each batch on the next animation frame, a number sends
+//              it after that many milliseconds. Call flush() to send
+//              the current batch right away.
+//
+//      reconnectInterval, maxReconnectInterval:
+//              Reconnect after a random delay of up to
+//              reconnectInterval ms (1000), doubling with each failed
+//              attempt up to maxReconnectInterval ms (30000).
+//
+//      The server can ask the socket to reconnect, after a delay and
+//      optionally to another URL, with a 'clientsignal.reconnect'
+//      event. The socket stays connected until then.
+//
+// Topics:
+//
+//      sock.subscribe('order:1234');
+//
+//      Only receive signals sent with topic='order:1234' once
+//      subscribed. Subscriptions are sent again whenever the socket
+//      reconnects.
+//
+// Replay:
+//
+//      sock.on('resync', function() {
+//          // Reload whatever the signals keep up to date.
+//      });
+//
+//      When the socket reconnects, the server sends the broadcasts
+//      that were missed while it was disconnected. If it can't (they
+//      are too old, or the socket reconnected to a different server
+//      process) it sends 'resync' instead. A broadcast that arrives
+//      both live and in the replay is only dispatched once.
+//
+var SignalSocket = function(url, protocols, options) {
     protocols = protocols || ['websocket', 'xdr-streaming', 'xhr-streaming', 'iframe-eventsource', 'iframe-htmlfile', 'xdr-polling', 'xhr-polling', 'iframe-xhr-polling', 'jsonp-polling'];
+    options = options || {};
     var conn = new ReconnectingSocket(url, protocols);
     this.conn = conn;
+    if (options.reconnectInterval)
+        conn.reconnectInterval = options.reconnectInterval;
+    if (options.maxReconnectInterval)
+        conn.maxReconnectInterval = options.maxReconnectInterval;
+
+    // The negotiated binary codec, if any, and its table of event names
+    // to integer ids (and back).
+    var codec = null;
+    var eventIds = {};
+    var eventNames = {};
+
+    // The server process's broadcast stream, and the sequence number of
+    // the last broadcast received from it.
+    var epoch = null;
+    var lastSeq = 0;
+
+    // While resuming, broadcasts can arrive both live and in the replay,
+    // in either order, so the sequence numbers seen are kept to drop the
+    // second copy. Once the server says the replay is done, anything up
+    // to where it got to is a copy.
+    var seen = null;
+    var floor = null;
 
     var callbacks = {};
     this.on = function(event_name, callback) {
@@ -203,24 +506,209 @@ var SignalSocket = function(url, protocols) {
         return this;
     };
 
+    // Events waiting to be sent as a batch, and whether a flush is 
+    // scheduled.
+    var batch = [];
+    var flushScheduled = false;
+
     this.send = function(event_name, event_data){
-        var payload = JSON.stringify({event:event_name, data:event_data});
-        conn.send(payload);
+        if (!options.batch) {
+            conn.send(encode([[event_name, event_data]]));
+            return this;
+        }
+
+        batch.push([event_name, event_data]);
+        if (!flushScheduled) {
+            flushScheduled = true;
+            if (options.batch === true && window.requestAnimationFrame)
+                window.requestAnimationFrame(flush);
+            else
+                setTimeout(flush, options.batch === true ? 0 : options.batch);
+        }
+        return this;
+    };
+
+    this.flush = function() {
+        flush();
+        return this;
+    };
+
+    // Topics this socket is subscribed to.
+    var topics = {};
+
+    this.subscribe = function(topic) {
+        topics[topic] = true;
+        if (conn.readyState === SockJS.OPEN)
+            conn.send(encode([['clientsignal.subscribe', {topic:topic}]]));
+        return this;
+    };
+
+    this.unsubscribe = function(topic) {
+        if (!topics.hasOwnProperty(topic))
+            return this;
+        delete topics[topic];
+        if (conn.readyState === SockJS.OPEN)
+            conn.send(encode([['clientsignal.unsubscribe', {topic:topic}]]));
         return this;
     };
 
     this.close = function() {
+        flush();
         conn.close();
     };
 
+    var flush = function() {
+        flushScheduled = false;
+        // Hold on to the batch until we're connected.
+        if (batch.length === 0 || conn.readyState !== SockJS.OPEN)
+            return;
+
+        var events = batch;
+        batch = [];
+        conn.send(encode(events));
+    };
+
+    // Encode a list of [name, data] events. A single event is sent on
+    // its own, more than one as an array.
+    var encode = function(events) {
+        var encoded = [];
+        for (var i = 0; i < events.length; i++) {
+            var event_name = events[i][0];
+            var event_data = events[i][1];
+            if (codec === 'msgpack') {
+                var id = eventIds.hasOwnProperty(event_name) ? 
+                    eventIds[event_name] : event_name;
+                encoded.push([id, event_data]);
+            } else {
+                encoded.push({event:event_name, data:event_data});
+            }
+        }
+
+        var message = encoded.length === 1 ? encoded[0] : encoded;
+        if (codec === 'msgpack')
+            return btoa(MessagePack.encode(message));
+        return JSON.stringify(message);
+    };
+
+    var decode = function(message) {
+        // JSON messages are objects or arrays, base64 never starts
+        // with a brace or bracket.
+        var first = message.charAt(0);
+        if (first === '{' || first === '[') 
+            return JSON.parse(message);
+
+        var evt = MessagePack.decode(atob(message));
+        return {
+            event: typeof evt[0] === 'number' ? eventNames[evt[0]] : evt[0],
+            data: evt[1],
+            seq: evt[2]
+        };
+    };
+
+    var hello = function(data) {
+        if (data.codec === 'msgpack') {
+            eventIds = data.events;
+            eventNames = {};
+            for (var name in eventIds) {
+                if (eventIds.hasOwnProperty(name))
+                    eventNames[eventIds[name]] = name;
+            }
+            codec = data.codec;
+        }
+    };
+
+    // A reconnect the server asked for.
+    var reconnectTimer = null;
+    var reconnect = function(data) {
+        clearTimeout(reconnectTimer);
+        reconnectTimer = setTimeout(function() {
+            reconnectTimer = null;
+            conn.reconnectNow(data.url);
+        }, data.delay || 0);
+    };
+
+    var stream = function(data) {
+        // A different stream's sequence numbers start over.
+        if (data.epoch !== epoch) {
+            epoch = data.epoch;
+            lastSeq = data.seq;
+            seen = floor = null;
+        }
+    };
+
+    var resumed = function(data) {
+        floor = data.epoch === epoch ? Math.max(floor, data.seq) : null;
+        seen = null;
+    };
+
+    // Whether the broadcast with this sequence number was already
+    // dispatched.
+    var duplicate = function(seq) {
+        if (floor !== null && seq <= floor)
+            return true;
+        if (seen !== null) {
+            if (seen[seq])
+                return true;
+            seen[seq] = true;
+        }
+        return false;
+    };
+
     // dispatch to the right handlers
     conn.onmessage = function(evt){
-        var json = JSON.parse(evt.data);
+        var json = decode(evt.data);
+        if (json.event === 'clientsignal.hello') {
+            hello(json.data);
+            return;
+        }
+        if (json.event === 'clientsignal.stream') {
+            stream(json.data);
+            return;
+        }
+        if (json.event === 'clientsignal.reconnect') {
+            reconnect(json.data);
+            return;
+        }
+        if (json.event === 'clientsignal.resumed') {
+            resumed(json.data);
+            return;
+        }
+        if (json.event === 'clientsignal.resync') {
+            dispatch('resync', null);
+            return;
+        }
+        if (typeof json.seq === 'number') {
+            if (duplicate(json.seq))
+                return;
+            if (json.seq > lastSeq)
+                lastSeq = json.seq;
+        }
         dispatch(json.event, json.data);
     };
 
     conn.onclose = function() { dispatch('close', null); };
-    conn.onopen = function() { dispatch('open', null); };
+    conn.onopen = function() { 
+        // Every new connection starts out as JSON.
+        codec = null;
+        if (options.binary) {
+            conn.send(JSON.stringify({event:'clientsignal.hello', 
+                data:{codecs:['msgpack']}}));
+        }
+        for (var topic in topics) {
+            if (topics.hasOwnProperty(topic))
+                conn.send(encode([['clientsignal.subscribe', {topic:topic}]]));
+        }
+        // Ask for the broadcasts we missed, once subscribed to the
+        // topics they might have been sent to.
+        if (epoch !== null) {
+            conn.send(encode([['clientsignal.resume', 
+                {epoch:epoch, seq:lastSeq}]]));
+            floor = lastSeq;
+            seen = {};
+        }
+        dispatch('open', null); 
+        flush();
+    };
     conn.onerror = function() { dispatch('error', null); };
 
     var dispatch = function(event_name, message){
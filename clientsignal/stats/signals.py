@@ -39,16 +39,26 @@ from django.dispatch import Signal, receiver
 import clientsignal.settings as app_settings
 
 from clientsignal.conn import SimpleSignalConnection
-from clientsignal.redisconn import RedisSignalConnection
+from clientsignal.redisconn import RedisSignalConnection, PUBLISH_STATS
+from clientsignal.socket import get_fanout_queue
 from clientsignal.utils import get_class_or_func, get_routers
 
 
 
+# Stats are sent every period anyway, so missed ones aren't replayed.
 class StatsSignalConnection(SimpleSignalConnection):
-    pass
+    replay_size = 0
+
+    def on_open(self, connection_info):
+        super(StatsSignalConnection, self).on_open(connection_info)
+        start_stats()
 
 class RedisStatsSignalConnection(RedisSignalConnection):
-    pass
+    replay_size = 0
+
+    def on_open(self, connection_info):
+        super(RedisStatsSignalConnection, self).on_open(connection_info)
+        start_stats()
 
 stat_broadcast = Signal(providing_args=["stats"])
 # StatsSignalConnection.broadcast('stat_broadcast', stat_broadcast)
@@ -68,9 +78,24 @@ def _send_stats():
             (Counter(dict(x)) for x in router_stats_dicts),
             Counter())
 
+    queue_stats = sum((c._queue_stats for c in stat_connections), Counter())
+    router_stats['messages_dropped'] = queue_stats['dropped']
+    router_stats['messages_coalesced'] = queue_stats['coalesced']
+    router_stats['queue_disconnects'] = queue_stats['disconnected']
+
+    router_stats['publish_queued'] = PUBLISH_STATS['queued']
+    router_stats['publish_dropped'] = PUBLISH_STATS['dropped']
+    router_stats['publish_replayed'] = PUBLISH_STATS['replayed']
+
+    fanouts, fanout_avg, fanout_max = get_fanout_queue().sample_stats()
+    router_stats['fanouts'] = fanouts
+    router_stats['fanout_avg_ms'] = round(fanout_avg, 2)
+    router_stats['fanout_max_ms'] = round(fanout_max, 2)
+
     clients_list = [(c.request.user.username, c.__class__.__name__)
                     for c in StatsSignalConnection.clients
-                    if c.__class__ in stat_connections]
+                    if c.__class__ in stat_connections
+                    and c.request is not None]
     clients = defaultdict(list)
     [clients[k].append(v) for v, k in clients_list]
 
@@ -81,7 +106,13 @@ def _send_stats():
     
     stat_broadcast.send(sender=host, stats=stats)
 
-if app_settings.CLIENTSIGNAL_STATS['period'] > 0:
-    loop = tornado.ioloop.PeriodicCallback(_send_stats,
-            app_settings.CLIENTSIGNAL_STATS['period'])
-    loop.start()
+# Stats are sampled once the first stats connection opens, rather than
+# on import, so that importing this module doesn't create the IOLoop
+# (runsocket --workers needs it created after forking).
+loop = None
+def start_stats():
+    global loop
+    if loop is None and app_settings.CLIENTSIGNAL_STATS['period'] > 0:
+        loop = tornado.ioloop.PeriodicCallback(_send_stats,
+                app_settings.CLIENTSIGNAL_STATS['period'])
+        loop.start()
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Will Barton.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#   1. Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL
+# THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+# A backend on Redis Streams rather than pub/sub. Each channel is a
+# stream, trimmed to about STREAM_MAXLEN entries, and each process
+# reads the streams its connections need with XREAD, from the last
+# entry it has read. A process that loses its connection to Redis
+# carries on from there when it's back, rather than missing everything
+# published in the meantime, unless the stream has been trimmed past it.
+#
+#   CLIENTSIGNAL_BACKEND = 'redis+streams://localhost:6379/0'
+#
+# This needs Redis 5.0 or later.
+
+import time
+import threading
+
+import tornado.ioloop
+import redis
+
+import clientsignal.settings as app_settings
+from clientsignal.backend import Subscriber, BackendSignalConnection
+from clientsignal.redisconn import RedisPublisher, SyncRedisPublisher
+from clientsignal.redisconn import get_redis_pool
+from clientsignal.utils import ioloop_running
+
+import logging
+log = logging.getLogger(__name__)
+
+# Streams are trimmed to about this many entries.
+STREAM_MAXLEN = app_settings.CLIENTSIGNAL_BACKEND_OPTIONS.get(
+        'STREAM_MAXLEN', 10000)
+
+# The longest each XREAD waits for new entries, in milliseconds.
+STREAM_BLOCK = app_settings.CLIENTSIGNAL_BACKEND_OPTIONS.get(
+        'STREAM_BLOCK', 100)
+
+
+# Streams are deleted once nothing has been added to them for this many
+# seconds, so that the streams of topics and users that are done with
+# don't stay in Redis.
+STREAM_TTL = app_settings.CLIENTSIGNAL_BACKEND_OPTIONS.get(
+        'STREAM_TTL', 86400)
+
+
+def xadd(client, channel, message):
+    """ Append the message to the channel's stream, trimming it, and
+    put off its expiry. redis 2.x has no xadd(). """
+    client.execute_command('XADD', channel, 'MAXLEN', '~',
+            STREAM_MAXLEN, '*', 'm', message)
+    if STREAM_TTL:
+        client.execute_command('EXPIRE', channel, STREAM_TTL)
+
+
+def parse_id(entry_id):
+    """ A stream entry id, "milliseconds-sequence", as a tuple that
+    sorts in order. """
+    ms, seq = entry_id.split('-')
+    return int(ms), int(seq)
+
+
+class StreamPublisher(RedisPublisher):
+    """ Pipelines XADDs once per IOLoop iteration. """
+
+    commands_per_message = 2 if STREAM_TTL else 1
+
+    def publish_command(self, client, channel, message):
+        xadd(client, channel, message)
+
+
+class SyncStreamPublisher(SyncRedisPublisher):
+    """ XADDs from outside of the IOLoop. """
+
+    def publish_command(self, client, channel, message):
+        xadd(client, channel, message)
+
+
+PUBLISHER = None
+SYNC_PUBLISHER = None
+def get_stream_publisher():
+    global PUBLISHER, SYNC_PUBLISHER
+    if not ioloop_running():
+        if SYNC_PUBLISHER is None:
+            SYNC_PUBLISHER = SyncStreamPublisher()
+        return SYNC_PUBLISHER
+
+    if PUBLISHER is None:
+        PUBLISHER = StreamPublisher()
+    return PUBLISHER
+
+
+class StreamSubscriber(Subscriber):
+    """
+    Reads this process's streams in a thread, with a blocking XREAD, and
+    hands the entries to the IOLoop. The thread keeps the id of the last
+    entry read from each stream, and reads on from there after losing
+    and regaining its connection to Redis. If a stream was trimmed past
+    that id in the meantime, the replay buffers are told that broadcasts
+    were lost.
+    """
+
+    # Seconds to wait before reading again after an error.
+    reconnect_delay = 1
+
+    # The most entries to read at once.
+    count = 1000
+
+    def __init__(self):
+        super(StreamSubscriber, self).__init__()
+        self.io_loop = None
+        self.thread = None
+        # The streams to read, which subscribe() and unsubscribe()
+        # change on the IOLoop.
+        self.streams = set()
+        self.lock = threading.Lock()
+        # Stream -> the id of the last entry read from it. Only the
+        # reading thread uses these.
+        self.offsets = {}
+        self.reconnected = False
+
+    def subscribe(self, channel):
+        with self.lock:
+            self.streams.add(channel)
+
+        if self.thread is None:
+            self.io_loop = tornado.ioloop.IOLoop.instance()
+            self.thread = threading.Thread(target=self.run,
+                    name='clientsignal-streams')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def unsubscribe(self, channel):
+        with self.lock:
+            self.streams.discard(channel)
+
+    def resubscribe(self):
+        # The thread keeps reading the same streams.
+        pass
+
+    def run(self):
+        client = redis.StrictRedis(connection_pool=get_redis_pool())
+        while True:
+            try:
+                self.read(client)
+            except redis.RedisError, e:
+                log.error("Cannot read from Redis, retrying in %ss: %s" %
+                        (self.reconnect_delay, e))
+                self.reconnected = True
+                time.sleep(self.reconnect_delay)
+
+    def read(self, client):
+        with self.lock:
+            streams = set(self.streams)
+
+        # Streams that have just been subscribed to are read from their
+        # last entry on.
+        for stream in streams - set(self.offsets):
+            self.offsets[stream] = self.last_id(client, stream)
+        for stream in set(self.offsets) - streams:
+            del self.offsets[stream]
+
+        if not self.offsets:
+            time.sleep(STREAM_BLOCK / 1000.0)
+            return
+
+        if self.reconnected:
+            self.reconnected = False
+            self.check_trimmed(client)
+
+        names = list(self.offsets)
+        reply = client.execute_command('XREAD', 'COUNT', self.count,
+                'BLOCK', STREAM_BLOCK, 'STREAMS',
+                *(names + [self.offsets[name] for name in names]))
+
+        messages = []
+        for stream, entries in reply or ():
+            for entry_id, fields in entries:
+                self.offsets[stream] = entry_id
+                # Fields are a flat list of names and values.
+                messages.append((stream, fields[1]))
+
+        if messages:
+            self.io_loop.add_callback(self.on_messages, messages)
+
+    def last_id(self, client, stream):
+        entries = client.execute_command('XREVRANGE', stream, '+', '-',
+                'COUNT', 1)
+        return entries[0][0] if entries else '0-0'
+
+    def check_trimmed(self, client):
+        """ After an outage, check that nothing we haven't read has been
+        trimmed from the streams. """
+        for stream, offset in self.offsets.items():
+            if offset != '0-0' and self.trimmed_past(client, stream, offset):
+                log.error("Redis stream %s was trimmed past %s" %
+                        (stream, offset))
+                self.io_loop.add_callback(self.on_lost)
+                return
+
+    def trimmed_past(self, client, stream, offset):
+        """ Whether entries after offset were trimmed from the stream. """
+        # Trimming takes the oldest entries first, so while the last one
+        # we read is there, nothing after it has gone.
+        if client.execute_command('XRANGE', stream, offset, offset):
+            return False
+
+        # It's gone, and there's no knowing whether the entries after
+        # it went too, unless Redis (7 and later) says which was the
+        # newest trimmed. Otherwise assume they did.
+        try:
+            info = client.execute_command('XINFO', 'STREAM', stream)
+        except redis.ResponseError:
+            return True
+        info = dict(zip(info[::2], info[1::2]))
+        deleted = info.get('max-deleted-entry-id')
+        return deleted is None or parse_id(deleted) > parse_id(offset)
+
+    def on_messages(self, messages):
+        for stream, body in messages:
+            self.on_channel_message(stream, body)
+
+
+SUBSCRIBER = None
+def get_stream_subscriber():
+    global SUBSCRIBER
+    if SUBSCRIBER is None:
+        SUBSCRIBER = StreamSubscriber()
+    return SUBSCRIBER
+
+
+class RedisStreamSignalConnection(BackendSignalConnection):
+    """
+    A signal connection that publishes its broadcast signals to Redis
+    Streams, so that processes that lose their connection to Redis
+    catch up on what they missed.
+    """
+
+    @classmethod
+    def get_publisher(cls):
+        return get_stream_publisher()
+
+    @classmethod
+    def get_subscriber(cls):
+        return get_stream_subscriber()
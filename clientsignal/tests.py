@@ -0,0 +1,774 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Will Barton.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without 
+# modification, are permitted provided that the following conditions
+# are met:
+# 
+#   1. Redistributions of source code must retain the above copyright 
+#      notice, this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright 
+#      notice, this list of conditions and the following disclaimer in the 
+#      documentation and/or other materials provided with the distribution.
+#   3. The name of the author may not be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY
+# AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL
+# THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Don't import clientsignal.socket as socket.
+from __future__ import absolute_import
+
+import os
+import json
+import shutil
+import socket
+import tempfile
+
+import tornadoredis
+
+from django import http
+from django.dispatch import Signal
+from django.utils import unittest
+
+from sockjs.tornado import SockJSRouter
+from sockjs.tornado.session import Session, OPEN
+
+from clientsignal import conn
+from clientsignal.conn import SimpleSignalConnection, BaseSignalConnection
+from clientsignal.backend import BackendSignalConnection
+from clientsignal.socket import EventConnection, get_fanout_queue
+from clientsignal.socket import DROP_OLDEST, DROP_NEWEST, COALESCE
+from clientsignal.socket import DISCONNECT, HELLO_EVENT
+from clientsignal.codec import JSONCodec, FastJSONCodec, msgpack
+from clientsignal.codec import get_codec
+from clientsignal.batch import BatchedBroadcastMiddleware
+from clientsignal.batch import add_to_batch, batched_broadcasts, get_batch
+from clientsignal.utils import get_backend_url_parts
+from clientsignal import redisconn
+from clientsignal.redisconn import get_redis_args, get_tornadoredis_args
+from clientsignal import streamconn
+from clientsignal import ipcconn
+from clientsignal.management.commands.runsocket import Drain
+
+
+class FakeHandler(object):
+    # Stands in for a SockJS transport, keeping what's written to it.
+    active = True
+    request = None
+
+    def __init__(self):
+        self.packs = []
+
+    def send_pack(self, pack, binary=False):
+        self.packs.append(pack)
+
+    def session_closed(self):
+        pass
+
+    def messages(self):
+        return [m for p in self.packs if p[0] == 'a' 
+                for m in json.loads(p[1:])]
+
+    def events(self):
+        return [json.loads(m) for m in self.messages()]
+
+
+def open_session(conn_cls, router, key):
+    """ An open SockJS session for a connection of the class, written to
+    a FakeHandler. """
+    session = Session(conn_cls, router, key)
+    session.state = OPEN
+    session.handler = FakeHandler()
+    session.send_queue = ''
+    session.transport_name = 'websocket'
+    router.stats.on_sess_opened('websocket')
+    return session
+
+
+class CodecTestCase(unittest.TestCase):
+
+    def test_json(self):
+        for codec in (JSONCodec(), FastJSONCodec()):
+            message = codec.encode_event('a', {'x': [1, u'\xe9']})
+            self.assertEqual(codec.decode(message), 
+                    {'event': 'a', 'data': {'x': [1, u'\xe9']}})
+            self.assertEqual(codec.decode(codec.add_sequence(message, 7)),
+                    {'event': 'a', 'data': {'x': [1, u'\xe9']}, 'seq': 7})
+
+    def test_get_codec(self):
+        codec = JSONCodec()
+        self.assertTrue(get_codec(codec) is codec)
+        self.assertTrue(get_codec('json') is get_codec('json'))
+        self.assertTrue(isinstance(
+            get_codec('clientsignal.codec.FastJSONCodec'), FastJSONCodec))
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        codec = get_codec('msgpack').with_events(['b', 'a'])
+        self.assertEqual(codec.event_ids, {'a': 0, 'b': 1})
+
+        message = codec.encode_event('b', {'x': 1}, 3)
+        self.assertEqual(codec.decode(message), 
+                {'event': 'b', 'data': {'x': 1}, 'seq': 3})
+        # Names in the table go as their numbers, others as themselves.
+        self.assertEqual(get_codec('msgpack').decode(message)['event'], 1)
+        self.assertEqual(codec.decode(codec.encode_event('c', {}))['event'],
+                'c')
+        self.assertEqual(codec.decode(codec.add_sequence(message, 4))['seq'],
+                4)
+
+        batch = codec.encode([[0, {}], ['c', {'y': 2}]])
+        self.assertEqual(codec.decode(batch), [{'event': 'a', 'data': {}},
+            {'event': 'c', 'data': {'y': 2}}])
+        self.assertRaises(ValueError, codec.decode, '{"event":"a"}')
+
+
+class HelloConnection(EventConnection):
+    flush_delay = None
+    binary_codec = 'msgpack'
+
+    def event_ping(self, **kwargs):
+        self.pings.append(kwargs)
+
+
+class HelloTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.router = SockJSRouter(HelloConnection, '/hello')
+        self.session = open_session(HelloConnection, self.router, 'hello')
+        self.connection = self.session.conn
+        self.connection.pings = []
+
+    def hello(self, codecs):
+        self.connection.on_message(json.dumps({'event': HELLO_EVENT,
+            'data': {'codecs': codecs}}))
+        return self.session.handler.events()[-1]
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_binary(self):
+        reply = self.hello(['msgpack'])
+        codec = HelloConnection.get_binary_codec()
+        # The reply is JSON; the client switches once it has it.
+        self.assertEqual(reply['data'], 
+                {'codec': 'msgpack', 'events': codec.event_ids})
+        self.assertTrue(self.connection._codec is codec)
+
+        self.connection.send('ping', x=1)
+        message = self.session.handler.messages()[-1]
+        self.assertEqual(codec.decode(message), 
+                {'event': 'ping', 'data': {'x': 1}})
+
+        # JSON sent before the client switched is still understood.
+        self.connection.on_message('{"event":"ping","data":{"y":1}}')
+        self.connection.on_message(codec.encode_event('ping', {'z': 1}))
+        self.assertEqual(self.connection.pings, [{'y': 1}, {'z': 1}])
+
+    def test_unsupported(self):
+        reply = self.hello(['cbor'])
+        self.assertEqual(reply['data'], {'codec': None})
+        self.assertTrue(self.connection._codec is HelloConnection._codec)
+
+
+class QueuedConnection(EventConnection):
+    flush_delay = 1000
+    flush_size = 1 << 20
+    max_queue = 2
+    overflow_policy = DROP_OLDEST
+
+
+class OutboxTestCase(unittest.TestCase):
+
+    def setUp(self):
+        QueuedConnection._queue_limits.clear()
+        QueuedConnection._queue_stats.clear()
+        self.router = SockJSRouter(QueuedConnection, '/queued')
+        self.session = open_session(QueuedConnection, self.router, 'queued')
+        self.connection = self.session.conn
+
+    def tearDown(self):
+        self.session.close()
+
+    def send(self, *events):
+        for name, kwargs in events:
+            self.connection.send(name, **kwargs)
+
+    def flushed(self):
+        self.connection.flush()
+        return [(e['event'], e['data']) for e in 
+                self.session.handler.events()]
+
+    def test_flush_window(self):
+        self.send(('a', {}), ('b', {}))
+        self.assertEqual(self.session.handler.packs, [])
+        self.assertEqual(self.flushed(), [('a', {}), ('b', {})])
+        # In one frame.
+        self.assertEqual(len(self.session.handler.packs), 1)
+
+    def test_flush_size(self):
+        self.connection.flush_size = 20
+        self.send(('a', {'x': 'x' * 20}))
+        self.assertEqual(len(self.session.handler.packs), 1)
+
+    def test_drop_oldest(self):
+        self.send(('a', {}), ('b', {}), ('c', {}))
+        self.assertEqual(self.flushed(), [('b', {}), ('c', {})])
+        self.assertEqual(QueuedConnection._queue_stats['dropped'], 1)
+
+    def test_drop_newest(self):
+        self.connection.overflow_policy = DROP_NEWEST
+        self.send(('a', {}), ('b', {}), ('c', {}))
+        self.assertEqual(self.flushed(), [('a', {}), ('b', {})])
+        self.assertEqual(QueuedConnection._queue_stats['dropped'], 1)
+
+    def test_disconnect(self):
+        self.connection.overflow_policy = DISCONNECT
+        self.send(('a', {}), ('b', {}), ('c', {}))
+        self.assertTrue(self.connection.is_closed)
+        self.assertEqual(QueuedConnection._queue_stats['disconnected'], 1)
+        self.assertEqual(self.flushed(), [])
+
+    def test_coalesce(self):
+        QueuedConnection.set_queue_limit('pos', policy=COALESCE, 
+                coalesce_key='id')
+        self.connection.max_queue = None
+        self.send(('pos', {'id': 1, 'x': 1}), ('pos', {'id': 2, 'x': 1}), 
+                ('pos', {'id': 1, 'x': 2}))
+        self.assertEqual(self.flushed(), [('pos', {'id': 2, 'x': 1}), 
+            ('pos', {'id': 1, 'x': 2})])
+        self.assertEqual(QueuedConnection._queue_stats['coalesced'], 1)
+
+    def test_event_limit(self):
+        # Only the limited event's own messages are dropped for it.
+        QueuedConnection.set_queue_limit('tick', max_queue=1)
+        self.connection.max_queue = None
+        self.send(('a', {}), ('tick', {'n': 1}), ('b', {}), 
+                ('tick', {'n': 2}))
+        self.assertEqual(self.flushed(), 
+                [('a', {}), ('b', {}), ('tick', {'n': 2})])
+
+    def test_backed_up(self):
+        # Messages stay queued, under the limits, until the client 
+        # catches up.
+        self.session.send_queue = 'x'
+        self.send(('a', {}), ('b', {}), ('c', {}))
+        self.assertEqual(self.flushed(), [])
+        self.session.send_queue = ''
+        self.assertEqual(self.flushed(), [('b', {}), ('c', {})])
+
+
+class BatchConnection(QueuedConnection):
+
+    @classmethod
+    def publish_many(cls, events):
+        cls.published.append(events)
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        BatchConnection._queue_limits.clear()
+        BatchConnection.published = []
+        self.middleware = BatchedBroadcastMiddleware()
+
+    def tearDown(self):
+        # Nothing may be left open for the next test.
+        self.assertTrue(get_batch() is None)
+
+    def request(self, status, *names):
+        request = http.HttpRequest()
+        self.middleware.process_request(request)
+        for name in names:
+            self.assertTrue(add_to_batch(BatchConnection, name, {}))
+        if status is not None:
+            self.middleware.process_response(request, 
+                    http.HttpResponse(status=status))
+        return request
+
+    def test_sent_with_response(self):
+        self.request(200, 'a', 'b')
+        self.assertEqual(BatchConnection.published, 
+                [[('a', {}), ('b', {})]])
+        self.assertFalse(add_to_batch(BatchConnection, 'c', {}))
+
+    def test_dropped_on_error(self):
+        self.request(500, 'a')
+        request = self.request(None, 'b')
+        self.middleware.process_exception(request, ValueError())
+        self.assertEqual(BatchConnection.published, [])
+
+    def test_leaked_batch(self):
+        # A request whose response never reached the middleware.
+        self.request(None, 'a')
+        self.request(200, 'b')
+        self.assertEqual(BatchConnection.published, [[('b', {})]])
+
+    def test_nested(self):
+        request = self.request(None, 'a')
+        with batched_broadcasts():
+            add_to_batch(BatchConnection, 'b', {})
+        try:
+            with batched_broadcasts():
+                add_to_batch(BatchConnection, 'c', {})
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(BatchConnection.published, [])
+        self.middleware.process_response(request, http.HttpResponse())
+        self.assertEqual(BatchConnection.published, 
+                [[('a', {}), ('b', {})]])
+
+    def test_coalesce(self):
+        BatchConnection.set_queue_limit('pos', coalesce_key='id')
+        request = self.request(None)
+        for kwargs in ({'id': 1, 'x': 1}, {'id': 2}, {'id': 1, 'x': 2}):
+            add_to_batch(BatchConnection, 'pos', kwargs)
+        self.middleware.process_response(request, http.HttpResponse())
+        self.assertEqual(BatchConnection.published, 
+                [[('pos', {'id': 1, 'x': 2}), ('pos', {'id': 2})]])
+
+
+class ChannelConnection(BackendSignalConnection):
+    __channel__ = 'tests'
+
+ChannelConnection.broadcast('user', Signal())
+ChannelConnection.broadcast('topic.user', Signal())
+
+
+class ChannelTestCase(unittest.TestCase):
+
+    def test_topic_channels_are_apart(self):
+        # Topics are named by clients, so none may name a user's or a
+        # signal's channel.
+        cls = ChannelConnection
+        others = set(cls.get_user_channel(pk) for pk in (1, '1', 'x'))
+        others.update(cls.get_signal_channels())
+        topics = ['user.1', 'user:1', ':user:1', '.user.1', 'x', 
+                'topic.user', '1']
+        for topic in topics:
+            self.assertNotIn(cls.get_topic_channel(topic), others)
+
+        class Other(BackendSignalConnection):
+            __channel__ = 'tests.topic'
+
+        self.assertNotEqual(cls.get_topic_channel('user.1'), 
+                Other.get_user_channel(1))
+
+
+class NameTestCase(unittest.TestCase):
+
+    def test_colon_in_names(self):
+        # Backend messages are split on ':'.
+        self.assertRaises(ValueError, ChannelConnection.broadcast, 
+                'a:b', Signal())
+        self.assertRaises(ValueError, ChannelConnection.listen, 
+                'a:b', Signal())
+        self.assertRaises(ValueError, ChannelConnection.send_to_user, 
+                1, 'a:b')
+        self.assertFalse('a:b' in ChannelConnection._broadcast_signals)
+
+
+class ReplayConnection(SimpleSignalConnection):
+    flush_delay = None
+    replay_size = 10
+
+ReplayConnection.broadcast('order', Signal())
+
+
+class ReplayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.router = SockJSRouter(ReplayConnection, '/replay')
+        self.queue = get_fanout_queue()
+
+    def tearDown(self):
+        for connection in list(ReplayConnection._connections):
+            connection.on_close()
+        self.queue.fanouts.clear()
+        del self.queue.chunk_size, self.queue.budget
+
+    def connect(self, key):
+        conn = open_session(ReplayConnection, self.router, key).conn
+        conn.topics = set()
+        conn.user_id = None
+        conn.request = True
+        ReplayConnection._connections.add(conn)
+        return conn
+
+    def test_resume_with_fanout_pending(self):
+        # A broadcast still in the fan-out queue when a connection
+        # resumes is sent to it twice, in the replay and then live. The
+        # resumed event tells the client where the replay got to, so
+        # that it can drop the second copy.
+        buf = ReplayConnection.get_replay_buffer()
+        self.queue.chunk_size = 1
+        self.queue.budget = -1
+
+        first, second = self.connect('first'), self.connect('second')
+        ReplayConnection.deliver([first, second], 'order', {'x': 1})
+        self.assertEqual(len(self.queue.fanouts), 1)
+
+        second.on_message(json.dumps({'event': 'clientsignal.resume', 
+            'data': {'epoch': buf.epoch, 'seq': buf.seq - 1}}))
+        while self.queue.fanouts:
+            self.queue.run()
+
+        events = second.session.handler.events()
+        self.assertEqual([e['event'] for e in events], 
+                ['order', 'clientsignal.resumed', 'order'])
+        self.assertEqual(events[0]['seq'], events[2]['seq'])
+        self.assertEqual(events[1]['data'], 
+                {'epoch': buf.epoch, 'seq': buf.seq})
+        self.assertTrue(events[2]['seq'] <= events[1]['data']['seq'])
+
+
+class RedisArgsTestCase(unittest.TestCase):
+
+    def test_db_and_password(self):
+        # The IOLoop's clients must reach the same db as the pooled ones.
+        url = get_backend_url_parts('redis+streams://:s%40cret@redis:6380/3')
+        self.assertEqual(get_redis_args(url), {'host': 'redis', 
+            'port': 6380, 'db': 3, 'password': 's@cret'})
+        self.assertEqual(get_tornadoredis_args(url), {'host': 'redis', 
+            'port': 6380, 'selected_db': 3, 'password': 's@cret'})
+
+    def test_defaults(self):
+        url = get_backend_url_parts('redis://')
+        self.assertEqual(get_tornadoredis_args(url), {'host': 'localhost',
+            'port': 6379, 'selected_db': 0, 'password': None})
+
+
+class FakePipeline(object):
+
+    def __init__(self):
+        self.commands = []
+
+    def execute_command(self, *args):
+        self.commands.append(args)
+
+
+class StreamPublishTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ttl = streamconn.STREAM_TTL
+        streamconn.STREAM_TTL = 60
+        self.publisher = streamconn.StreamPublisher()
+        self.publisher.commands_per_message = 2
+        self.failed = []
+        self.publisher.on_failed = lambda messages, error, replay: \
+                self.failed.append((messages, error))
+
+    def tearDown(self):
+        streamconn.STREAM_TTL = self.ttl
+
+    def test_xadd_expires(self):
+        pipe = FakePipeline()
+        self.publisher.publish_command(pipe, 'c:topic:t', 'x:sig:1')
+        self.assertEqual(pipe.commands[0][:2], ('XADD', 'c:topic:t'))
+        self.assertEqual(pipe.commands[1], ('EXPIRE', 'c:topic:t', 60))
+
+    def test_results_per_message(self):
+        # Only the message whose commands lost the connection is held.
+        error = tornadoredis.ConnectionError('gone')
+        messages = [('a', '1'), ('b', '2')]
+        self.publisher.on_published(messages, False, 
+                ['1-0', True, '1-1', error])
+        self.assertEqual(self.failed, [([('b', '2')], error)])
+
+
+class FakeRedisClient(object):
+
+    def __init__(self, up):
+        self.up = up
+        self.channels = []
+
+    def connect(self):
+        if not self.up:
+            raise tornadoredis.ConnectionError('refused')
+
+    def subscribe(self, channel, callback):
+        self.channels.append(channel)
+        callback(True)
+
+    def listen(self, callback, exit_callback):
+        pass
+
+
+class RedisSubscriberTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.new_client = redisconn.new_tornadoredis_client
+        self.up = False
+        self.clients = []
+        def new_client():
+            self.clients.append(FakeRedisClient(self.up))
+            return self.clients[-1]
+        redisconn.new_tornadoredis_client = new_client
+
+    def tearDown(self):
+        redisconn.new_tornadoredis_client = self.new_client
+
+    def test_retries_until_connected(self):
+        subscriber = redisconn.RedisSubscriber()
+        subscriber.register(ChannelConnection, 'a')
+        subscriber.register(ChannelConnection, 'b')
+        self.assertTrue(subscriber.reconnecting)
+        self.assertEqual(subscriber.client, None)
+        first = subscriber.backoff.current
+
+        # Still down: the next try backs off further.
+        subscriber.reconnect()
+        self.assertTrue(subscriber.reconnecting)
+        self.assertTrue(subscriber.backoff.current > first)
+
+        self.up = True
+        subscriber.reconnect()
+        self.assertFalse(subscriber.reconnecting)
+        self.assertFalse(subscriber.backoff.failing)
+        self.assertTrue(subscriber.client is self.clients[-1])
+        self.assertEqual(sorted(subscriber.client.channels), ['a', 'b'])
+
+
+class LoadSessionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.closed = 0
+        self.close = conn.close_old_connections
+        self.get_user = conn.get_user
+        def close():
+            self.closed += 1
+        conn.close_old_connections = close
+
+    def tearDown(self):
+        conn.close_old_connections = self.close
+        conn.get_user = self.get_user
+
+    def test_closes_connection(self):
+        session, user = conn.load_session(None)
+        self.assertFalse(user.is_authenticated())
+        self.assertEqual(self.closed, 1)
+
+    def test_closes_connection_on_error(self):
+        # A broken connection mustn't stay on the session thread.
+        def get_user(request):
+            raise RuntimeError('connection lost')
+        conn.get_user = get_user
+        self.assertRaises(RuntimeError, conn.load_session, None)
+        self.assertEqual(self.closed, 1)
+
+
+class RecordingPublisher(redisconn.RedisPublisher):
+
+    def __init__(self):
+        super(RecordingPublisher, self).__init__()
+        self.sent = []
+
+    def send(self, messages, replay=False):
+        self.sent.append((messages, replay))
+
+    def publish(self, *messages):
+        self.publish_many([('c', message) for message in messages])
+
+    def answer(self, *results):
+        messages, replay = self.sent[-1]
+        self.on_published(messages, replay, list(results))
+
+
+class RedisOutboxTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = RecordingPublisher()
+        self.lost = tornadoredis.ConnectionError('lost')
+
+    def test_replay_order(self):
+        p = self.publisher
+        p.publish('1', '2')
+        p.answer(self.lost, self.lost)
+        self.assertTrue(p.backoff.failing)
+
+        # Held behind the failed ones until the reconnect.
+        p.publish('3')
+        self.assertEqual(len(p.sent), 1)
+        p.reconnect()
+        self.assertEqual(p.sent[-1], ([('c', '1'), ('c', '2'), 
+            ('c', '3')], True))
+
+        # Sent while replaying, and the replay fails part way through:
+        # the unsent ones go back ahead of it.
+        p.publish('4')
+        p.answer(1, self.lost, self.lost)
+        p.reconnect()
+        self.assertEqual(p.sent[-1], ([('c', '2'), ('c', '3'), 
+            ('c', '4')], True))
+
+        p.answer(1, 1, 1)
+        self.assertFalse(p.backoff.failing)
+        p.publish('5')
+        self.assertEqual(p.sent[-1], ([('c', '5')], False))
+
+    def test_outbox_size(self):
+        outbox = redisconn.Outbox()
+        outbox.size = 2
+        dropped = redisconn.PUBLISH_STATS['dropped']
+        outbox.hold([('c', '1'), ('c', '2')])
+        outbox.hold([('c', '3')])
+        self.assertEqual(outbox.take(), [('c', '2'), ('c', '3')])
+        self.assertEqual(redisconn.PUBLISH_STATS['dropped'], dropped + 1)
+        self.assertEqual(len(outbox), 0)
+
+
+class FakeStream(object):
+    # Reads from what's been fed to it.
+
+    def __init__(self):
+        self.data = ''
+        self.reading = None
+        self.written = []
+
+    def closed(self):
+        return False
+
+    def read_bytes(self, count, callback):
+        self.reading = (count, callback)
+        self.feed('')
+
+    def feed(self, data):
+        self.data += data
+        while self.reading and len(self.data) >= self.reading[0]:
+            (count, callback), self.reading = self.reading, None
+            chunk, self.data = self.data[:count], self.data[count:]
+            callback(chunk)
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class IPCTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'broker.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_frames(self):
+        frames = []
+        def on_frame(stream, frame):
+            frames.append(ipcconn.decode_frame(frame))
+            if len(frames) == 1:
+                raise ValueError()
+
+        stream = FakeStream()
+        ipcconn.FrameReader(stream, on_frame)
+        data = ipcconn.encode_frame(ipcconn.SUBSCRIBE, u'c\xe9') + \
+                ipcconn.encode_frame(ipcconn.PUBLISH, 'c', 'a:b:c')
+        # Frames split across reads, and after one that fails.
+        for byte in data:
+            stream.feed(byte)
+        self.assertEqual(frames, [('S', 'c\xc3\xa9', ''), 
+            ('P', 'c', 'a:b:c')])
+
+    def test_broker(self):
+        broker = ipcconn.IPCBroker()
+        subscriber, publisher = FakeStream(), FakeStream()
+        broker.on_frame(subscriber, 
+                ipcconn.encode_frame(ipcconn.SUBSCRIBE, 'c')[4:])
+        frame = ipcconn.encode_frame(ipcconn.PUBLISH, 'c', 'm')
+        broker.on_frame(publisher, frame[4:])
+        broker.on_frame(publisher, 
+                ipcconn.encode_frame(ipcconn.PUBLISH, 'd', 'm')[4:])
+        self.assertEqual(subscriber.written, [frame])
+
+        broker.on_stream_close(subscriber)
+        self.assertEqual(dict(broker.channels), {})
+
+    def test_takeover(self):
+        first = ipcconn.bind_broker_socket(self.path)
+        self.assertTrue(first is not None)
+        # Someone's listening.
+        self.assertTrue(ipcconn.bind_broker_socket(self.path) is None)
+
+        # The broker's process has gone, leaving its socket.
+        first.close()
+        self.assertTrue(os.path.exists(self.path))
+        second = ipcconn.bind_broker_socket(self.path)
+        self.assertTrue(second is not None)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.path)
+        client.close()
+        second.close()
+
+
+class FakeServer(object):
+    stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class DrainConnection(object):
+
+    def __init__(self):
+        self.is_closed = False
+        self.delays = []
+        BaseSignalConnection.clients.add(self)
+
+    def reconnect(self, delay=0):
+        self.delays.append(delay)
+
+    def close(self):
+        self.is_closed = True
+        BaseSignalConnection.clients.discard(self)
+
+
+class DrainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clients = BaseSignalConnection.clients
+        BaseSignalConnection.clients = set()
+        self.server = FakeServer()
+
+    def tearDown(self):
+        self.drain.callback.stop()
+        BaseSignalConnection.clients = self.clients
+        BaseSignalConnection.draining = False
+
+    def test_batches(self):
+        connections = [DrainConnection() for i in range(4)]
+        self.drain = Drain(self.server, period=2)
+        self.drain.start()
+        self.assertTrue(self.server.stopped)
+        self.assertTrue(BaseSignalConnection.draining)
+
+        asked = [c for c in connections if c.delays]
+        self.assertEqual(len(asked), 2)
+        self.assertTrue(all(0 <= c.delays[0] <= 1000 for c in asked))
+        for c in asked:
+            c.close()
+
+        self.drain.start()
+        self.assertEqual(len([c for c in connections if c.delays]), 2)
+
+        self.drain.tick()
+        self.assertTrue(all(len(c.delays) == 1 for c in connections))
+        self.assertFalse(any(c.is_closed for c in connections 
+            if c not in asked))
+
+    def test_deadline(self):
+        connections = [DrainConnection() for i in range(2)]
+        self.drain = Drain(self.server, period=10)
+        self.drain.start()
+        self.drain.deadline = 0
+        self.drain.tick()
+        self.assertTrue(all(c.is_closed for c in connections))
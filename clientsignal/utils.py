@@ -33,11 +33,14 @@ from django.utils.importlib import import_module
 
 from django.core.exceptions import ImproperlyConfigured
 
+import tornado.ioloop
 from sockjs.tornado import SockJSRouter
 
 import clientsignal.settings as app_settings
 
 import itertools
+import time
+from collections import OrderedDict
 
 __signalconnection = SortedDict()
 
@@ -60,6 +63,55 @@ def get_class_or_func(import_path):
     return imported
 
 
+class ExpiringLRUCache(object):
+    """
+    A small least-recently-used cache whose entries also expire after
+    ttl seconds. It is not thread-safe and is meant to be used from the
+    IOLoop.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self._data.pop(key)
+        except KeyError:
+            return default
+
+        if expires < time.time():
+            return default
+
+        # Re-insert to mark it as most recently used.
+        self._data[key] = (expires, value)
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = (time.time() + self.ttl, value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+def ioloop_running():
+    """ Whether an IOLoop is running in the current thread. """
+    # IOLoop.start() makes the loop current for its thread. 
+    # IOLoop.current() would create one if there isn't.
+    io_loop = getattr(tornado.ioloop.IOLoop._current, 'instance', None)
+    return io_loop is not None and getattr(io_loop, '_running', False)
+
+
 def get_backend_url_parts(url):
     import urlparse
     from urllib import unquote